@@ -6,164 +6,360 @@ from astropy.io import fits
 import sys
 import argparse
 import os
+import multiprocessing
+import warnings
 import numpy as np
 
 
-def search_adj(cube, pos, nadj, minval):
-    """
-    Search adjacent pixels (in 3D) to see how many are greater than minval
-    """
-    count = 0
-    # deal with edge points
-    xlim = cube.shape[0]
-    ylim = cube.shape[1]
-    if pos[0] != 0:
-        if (cube[pos[0]-1, pos[1], pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[0] != xlim-1:
-        if (cube[pos[0]+1, pos[1], pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[1] != 0:
-        if (cube[pos[0], pos[1]-1, pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[1] != ylim-1:
-        if (cube[pos[0], pos[1]+1, pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[0] != xlim-1 and pos[1] != ylim-1:
-        if (cube[pos[0]+1, pos[1]+1, pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[0] != 0 and pos[1] != 0:
-        if (cube[pos[0]-1, pos[1]-1, pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[0] != 0 and pos[1] != ylim-1:
-        if (cube[pos[0]-1, pos[1]+1, pos[2], pos[3]] > minval):
-            count = count+1
-    if pos[0] != xlim-1 and pos[1] != 0:
-        if (cube[pos[0]+1, pos[1]-1, pos[2], pos[3]] > minval):
-            count = count+1
-
-    if count >= nadj:
-        return nadj
+def neighbour_count(above):
+    """
+    Count how many of the 8 spatially adjacent pixels are set in the boolean
+    array above (x, y, ...). Pixels beyond the edges count as unset.
+    """
+    count = np.zeros(above.shape, dtype=np.uint8)
+    nx = above.shape[0]
+    ny = above.shape[1]
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if dx == 0 and dy == 0:
+                continue
+            count[max(-dx, 0):nx-max(dx, 0), max(-dy, 0):ny-max(dy, 0)] += \
+                above[max(dx, 0):nx-max(-dx, 0), max(dy, 0):ny-max(-dy, 0)]
+    return count
+
+
+def sn_mask(data, minval):
+    """
+    Mask of pixels above minval or below -minval (to capture absorption).
+    Zero-valued pixels are excluded, NaNs are kept.
+    """
+    return (((data > minval) | (data < -1*minval)) & (data != 0)) | \
+        np.isnan(data)
+
+
+def adjacent_mask(chans, minval, nadj, wrap=None):
+    """
+    Mask of pixels in chans (x, y, v) which exceed minval (a scalar or one
+    value per channel) in two adjacent channels. If wrap is given, channel 0
+    is also compared against it; wrap is a boolean (x, y) array of pixels
+    exceeding the threshold in the comparison channel (the whole-cube
+    behaviour compares channel 0 with the last channel).
+
+    If nadj is non-zero, at least one pixel of each pair must also have nadj
+    spatially adjacent pixels exceeding minval.
+    """
+    above = chans > minval
+    pair = above[:, :, :-1] & above[:, :, 1:]
+    if wrap is not None:
+        wrap = above[:, :, 0] & wrap
+    if nadj:
+        near = neighbour_count(above) >= nadj
+        pair &= near[:, :, :-1] | near[:, :, 1:]
+        if wrap is not None:
+            wrap &= near[:, :, 0]
+    adjmask = np.zeros(above.shape, dtype=bool)
+    adjmask[:, :, :-1] |= pair
+    adjmask[:, :, 1:] |= pair
+    if wrap is not None:
+        adjmask[:, :, 0] |= wrap
+    return adjmask
+
+
+def slab_mask(chans, lo, hi, snval, snjval=None, nadj=0, wrap=None):
+    """
+    Mask for channels lo:hi of chans (x, y, v), where chans holds those
+    channels plus up to one halo channel on either side. snval and snjval
+    are scalars or per-channel arrays matching chans. If snjval is None the
+    adjacent channel criterion is skipped.
+    """
+    snval = np.broadcast_to(snval, chans.shape[2:3])
+    mask = sn_mask(chans[:, :, lo:hi], snval[lo:hi])
+    if snjval is not None:
+        mask |= adjacent_mask(chans, snjval, nadj, wrap=wrap)[:, :, lo:hi]
+    return mask
+
+
+def read_slab(raw, bscale, bzero, dtype, blank=None):
+    """
+    Read a slab from the (unscaled, memory-mapped) data and apply
+    BSCALE/BZERO. Pixels equal to BLANK (integer data only) become NaN.
+    """
+    if bscale == 1 and bzero == 0 and blank is None:
+        return np.asarray(raw)
+    data = raw.astype(dtype)
+    data *= bscale
+    data += bzero
+    if blank is not None:
+        data[raw == blank] = np.nan
+    return data
+
+
+def copy_extensions(cube, ofile, chunk=1 << 24):
+    """
+    Copy the extension HDUs of an open FITS file (e.g. the per-channel BEAMS
+    table of CASA cubes) byte for byte to the current position of ofile.
+    """
+    if len(cube) < 2:
+        return
+    start = cube[1].fileinfo()['hdrLoc']
+    last = cube[-1].fileinfo()
+    end = last['datLoc'] + last['datSpan']
+    with open(cube.filename(), 'rb') as ifile:
+        ifile.seek(start)
+        while start < end:
+            buf = ifile.read(min(chunk, end - start))
+            if not buf:
+                break
+            ofile.write(buf)
+            start += len(buf)
+
+
+def check_extensions(cubename, ofname):
+    """
+    Check that the output has the same extension HDUs (headers and data) as
+    the input cube. Returns a list of problems, empty if there are none.
+    """
+    problems = []
+    with fits.open(cubename, ignore_missing_end=True,
+                   do_not_scale_image_data=True) as cube, \
+            fits.open(ofname, do_not_scale_image_data=True) as out:
+        if len(out) != len(cube):
+            return [str(len(cube))+' HDUs in the input, '+str(len(out)) +
+                    ' in the output']
+        for i in range(1, len(cube)):
+            if cube[i].header != out[i].header:
+                problems.append('header of extension '+str(i)+' differs')
+            elif not np.array_equal(np.asarray(cube[i].data),
+                                    np.asarray(out[i].data)):
+                problems.append('data of extension '+str(i)+' differ')
+    return problems
+
+
+def estimate_rms(raw, bscale, bzero, slab=32, nsample=100000, nsigma=3.,
+                 niter=5, blank=None):
+    """
+    Robust noise estimate for each channel of the first Stokes plane of raw
+    (stokes, v, y, x), made in a single pass over the cube.
+
+    Each channel is subsampled on a regular grid of ~nsample pixels (NaNs and
+    zeros are ignored), then iteratively clipped at nsigma times the MAD
+    around the median. Returns the per-channel RMS; channels where no
+    estimate could be made are given the median over all channels.
+    """
+    nchan, ny, nx = raw.shape[1:]
+    step = max(1, int(np.sqrt(ny * nx / float(nsample))))
+    rms = np.empty(nchan)
+    for lo in range(0, nchan, slab):
+        hi = min(lo + slab, nchan)
+        data = read_slab(raw[0, lo:hi, ::step, ::step], bscale, bzero,
+                         np.float64, blank=blank)
+        data = np.array(data, dtype=np.float64).reshape(hi - lo, -1)
+        data[data == 0] = np.nan
+        with warnings.catch_warnings():
+            # fully blanked channels
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for i in range(niter):
+                med = np.nanmedian(data, axis=1)[:, None]
+                dev = np.abs(data - med)
+                mad = 1.4826 * np.nanmedian(dev, axis=1)[:, None]
+                data[dev > nsigma * mad] = np.nan
+            rms[lo:hi] = 1.4826 * np.nanmedian(np.abs(data - med), axis=1)
+    rms[~np.isfinite(rms)] = np.nanmedian(rms)
+    return rms
+
+# state for mask_task(), set up once per process by init_worker()
+_worker = {}
+
+
+def init_worker(cubename, ofname, offset, params):
+    """
+    Open the input cube and the preallocated output file as memory maps.
+    Called once in each worker process (or once in the main process for a
+    serial run).
+    """
+    cube = fits.open(cubename, mode='readonly', ignore_missing_end=True,
+                     memmap=True, do_not_scale_image_data=True)
+    raw = cube[0].data
+    _worker['cube'] = cube
+    _worker['raw'] = raw
+    _worker['out'] = np.memmap(ofname, dtype=params['dtype'].newbyteorder('>'),
+                               mode='r+', offset=offset, shape=raw.shape)
+    _worker.update(params)
+
+
+def mask_task(task):
+    """
+    Mask channels lo:hi of one Stokes plane and write them into the output
+    file. Tasks cover disjoint parts of the output, so they can run in any
+    order.
+    """
+    stokes, lo, hi = task
+    raw = _worker['raw']
+    bscale = _worker['bscale']
+    bzero = _worker['bzero']
+    blank = _worker['blank']
+    dtype = _worker['dtype']
+    nchan = raw.shape[1]
+    # one channel halo for the adjacent channel criterion
+    hlo = max(lo - 1, 0)
+    hhi = min(hi + 1, nchan)
+    data = read_slab(raw[stokes, hlo:hhi], bscale, bzero, dtype, blank=blank)
+    if stokes == 0:
+        # adjacent channel criterion (first Stokes axis only)
+        wrap = None
+        if lo == 0:
+            wrap = read_slab(raw[0, nchan-1], bscale, bzero, dtype,
+                             blank=blank).transpose() > \
+                _worker['snjval'][nchan-1]
+        mask = slab_mask(data.transpose(), lo-hlo, hi-hlo,
+                         _worker['snval'][hlo:hhi], _worker['snjval'][hlo:hhi],
+                         _worker['nadj'], wrap=wrap)
+    else:
+        mask = slab_mask(data.transpose(), lo-hlo, hi-hlo,
+                         _worker['snval'][hlo:hhi])
+    out = _worker['out']
+    out[stokes, lo:hi] = data[lo-hlo:hi-hlo]*mask.transpose()
+    out.flush()
+    return task
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a mask for a data cube')
+    parser.add_argument('cube', type=str, default=False, help='Data cube to mask')
+    parser.add_argument('-rms', type=float, default=None,
+                        help='RMS noise (Default: estimate the noise in each \
+channel from the cube).')
+    parser.add_argument('-globalrms', action='store_true',
+                        help='When estimating the noise, use the median over \
+all channels instead of per-channel values.')
+    parser.add_argument('-rmsout', type=str, default=None,
+                        help='Write the estimated noise spectrum to this file.')
+    parser.add_argument('-SN', type=float, default=-1,
+                        help='SN to use for individual pixels (Default: -1, \
+                             accept all pixels).')
+    parser.add_argument('-SNJ', type=float, default=-1,
+                        help='SN to use for pixels detected in >1 adjacent \
+                             channels (Default: -1, option disabled).')
+    parser.add_argument('-spatial', type=int, default=0,
+                        help='Require at adjacent pixel to also exceed the SNJ \
+                             threshold? (NOT YET IMPLEMENTED)')
+    parser.add_argument('-slab', type=int, default=32,
+                        help='Number of channels to hold in memory at a time \
+                             (per worker, Default: 32).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to mask slabs with \
+                             (Default: 1).')
+    args = parser.parse_args()
+
+    if args.cube:
+        print("Generating mask for "+args.cube+".")
     else:
-        return 0
-
-parser = argparse.ArgumentParser(description='Create a mask for a data cube')
-parser.add_argument('cube', type=str, default=False, help='Data cube to mask')
-parser.add_argument('-rms', type=float, default=-1, help='RMS noise')
-parser.add_argument('-SN', type=float, default=-1,
-                    help='SN to use for individual pixels (Default: -1, \
-                         accept all pixels).')
-parser.add_argument('-SNJ', type=float, default=-1,
-                    help='SN to use for pixels detected in >1 adjacent \
-                         channels (Default: -1, option disabled).')
-parser.add_argument('-spatial', type=int, default=0,
-                    help='Require at adjacent pixel to also exceed the SNJ \
-                         threshold? (NOT YET IMPLEMENTED)')
-args = parser.parse_args()
-
-if args.cube:
-    print("Generating mask for "+args.cube+".")
-else:
-    sys.stderr.write("ERROR: You must specify a data cube.\n\n")
-    sys.exit(-1)
-
-if args.rms:
-    print("Using RMS noise of "+str(args.rms)+" (in the units of the cube).")
-else:
-    sys.stderr.write("ERROR: You must specify a RMS noise value.\n\n")
-    sys.stderr.write("Eventually I'll get around to allowing the program \
-                     to compute this.\n\n")
-    sys.exit(-1)
-
-if args.SN == 1:
-    print("No SN specified, accepting all pixels.")
-if args.SNJ == -1:
-    print("Not taking into account pixels adjacent in frequency space.")
-if args.spatial:
-    print("Pixels must have at least "+str(args.spatial)+" adjacent pixels \
-          exceeding SN of "+str(args.SNJ))
-
-# let's get a move on
-if os.path.isfile(args.cube):
-    cube = fits.open(args.cube, mode='readonly', ignore_missing_end=True)
-else:
-    sys.stderr.write("ERROR: "+args.cube+" not found.\n\n")
-    sys.exit(-1)
-
-# transpose so the definition is sensible
-wdata = cube[0].data.transpose()*1
-
-cshape = wdata.shape
-
-if len(cshape) == 4:
-    # we have a velocity axis
-    nchan = cshape[2]
-    nstokes = cshape[3]
-elif len(cshape) == 3:
-    # no velocity axis
-    nstokes = cshape[2]
-imsize = (cshape[0], cshape[1])
-
-# simple mask for points which are above the SN threshold
-masku = wdata*(wdata > args.rms*args.SN)
-# do this for below the threshold too, we want to capture absorption
-maskl = wdata*(wdata < -1*args.rms*args.SN)
-mask = np.logical_or(masku, maskl)
-
-adjmask = np.zeros((imsize[0], imsize[1], nchan, nstokes))
-
-# now loop over the cube and look for adjacent pixels
-for v in range(0, nchan, 2):    # double assign goodness
-    for x in range(imsize[0]):
-        for y in range(imsize[1]):
-            if v != (nchan-1):  # compare chanel+1
-                if (wdata[x, y, v, 0] > args.rms*args.SNJ) and \
-                   (wdata[x, y, v+1, 0] > args.rms*args.SNJ):
-                    if args.spatial:
-                        # search spatially adjacent pixels
-                        if search_adj(wdata, (x, y, v, 0), args.spatial,
-                                      args.rms*args.SNJ) or \
-                           search_adj(wdata, (x, y, v+1, 0),
-                                      args.spatial, args.rms*args.SNJ):
-                            adjmask[x, y, v, 0] = adjmask[x, y, v+1, 0] = 1
-                    else:
-                        adjmask[x, y, v, 0] = adjmask[x, y, v+1, 0] = 1
-            if v != 0:  # compare chanel-1
-                if (wdata[x, y, v, 0] > args.rms*args.SNJ) and \
-                   (wdata[x, y, v-1, 0] > args.rms*args.SNJ):
-                    if args.spatial:
-                        # search spatially adjacent pixels
-                        if search_adj(wdata, (x, y, v, 0), args.spatial,
-                                      args.rms*args.SNJ) or \
-                           search_adj(wdata, (x, y, v-1, 0), args.spatial,
-                                      args.rms*args.SNJ):
-                            adjmask[x, y, v, 0] = adjmask[x, y, v-1, 0] = 1
-                    else:
-                        adjmask[x, y, v, 0] = adjmask[x, y, v-1, 0] = 1
-            else:
-                # just do a left compare
-                if (wdata[x, y, v, 0] > args.rms*args.SNJ) and \
-                   (wdata[x, y, v-1, 0] > args.rms*args.SNJ):
-                    if args.spatial:
-                        if search_adj(wdata, (x, y, v, 0), args.spatial,
-                                      args.rms*args.SNJ):
-                            adjmask[x, y, v, 0] = 1
-                    else:
-                        adjmask[x, y, v, 0] = 1
-
-# combine the masks
-fmask = np.ones((imsize[0], imsize[1], nchan, nstokes))*np.logical_or(mask,
-                                                                      adjmask)
-
-ofname = args.cube.split('.fits')[0]+'-masked.fits'
-if os.path.isfile(ofname):
-    os.remove(ofname)
-
-cube[0].data = cube[0].data*fmask.transpose()
-cube[0].header['comment'] = 'Masked data cube.'
-cube[0].header['comment'] = 'SN='+str(args.SN)+' SNJ='+str(args.SNJ) + \
-                            ' RMS='+str(args.rms)
-
-cube.writeto(ofname)
-
-cube.close()
+        sys.stderr.write("ERROR: You must specify a data cube.\n\n")
+        sys.exit(-1)
+
+    if args.rms is not None:
+        print("Using RMS noise of "+str(args.rms)+" (in the units of the cube).")
+
+    if args.SN == 1:
+        print("No SN specified, accepting all pixels.")
+    if args.SNJ == -1:
+        print("Not taking into account pixels adjacent in frequency space.")
+    if args.spatial:
+        print("Pixels must have at least "+str(args.spatial)+" adjacent pixels \
+              exceeding SN of "+str(args.SNJ))
+
+    # let's get a move on
+    if os.path.isfile(args.cube):
+        # leave the data memory-mapped and unscaled, slabs are scaled as read
+        cube = fits.open(args.cube, mode='readonly', ignore_missing_end=True,
+                         memmap=True, do_not_scale_image_data=True)
+    else:
+        sys.stderr.write("ERROR: "+args.cube+" not found.\n\n")
+        sys.exit(-1)
+
+    # FITS order is (stokes, velocity, y, x)
+    raw = cube[0].data
+    if raw.ndim != 4:
+        sys.stderr.write("ERROR: expected a cube with 4 axes "
+                         "(x, y, velocity, stokes).\n\n")
+        sys.exit(-1)
+    nstokes, nchan = raw.shape[0:2]
+
+    header = cube[0].header.copy()
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    # as in astropy, BLANK only applies to integer data
+    blank = header.get('BLANK') if raw.dtype.kind in 'iu' else None
+    dtype = raw.dtype.newbyteorder('=')
+
+    if args.rms is None:
+        rms = estimate_rms(raw, bscale, bzero, slab=max(args.slab, 1),
+                           blank=blank)
+        print("Estimated RMS noise: median "+str(np.median(rms))+", range " +
+              str(rms.min())+" to "+str(rms.max())+" (in the units of the \
+cube).")
+        if args.rmsout:
+            np.savetxt(args.rmsout, rms, header='channel RMS noise')
+        if args.globalrms:
+            rms = np.full(nchan, np.median(rms))
+        rmsstr = 'estimated (median '+str(np.median(rms))+')'
+    else:
+        rms = np.full(nchan, args.rms)
+        rmsstr = str(args.rms)
+
+    if bscale != 1 or bzero != 0 or blank is not None:
+        # the output is written as floats
+        dtype = np.dtype(np.float32 if raw.dtype.itemsize <= 2 else np.float64)
+        for kw in ['BSCALE', 'BZERO', 'BLANK']:
+            header.remove(kw, ignore_missing=True)
+        header['BITPIX'] = -8 * dtype.itemsize
+    header['comment'] = 'Masked data cube.'
+    header['comment'] = 'SN='+str(args.SN)+' SNJ='+str(args.SNJ) + \
+                        ' RMS='+rmsstr
+
+    ofname = args.cube.split('.fits')[0]+'-masked.fits'
+    if os.path.isfile(ofname):
+        os.remove(ofname)
+
+    # write the header and allocate the data section; slabs are filled in
+    # through a memory map by mask_task(). Any extensions follow unchanged.
+    hstr = header.tostring().encode('ascii')
+    nbytes = raw.size * dtype.itemsize
+    with open(ofname, 'wb') as ofile:
+        ofile.write(hstr)
+        ofile.truncate(len(hstr) + 2880 * ((nbytes + 2879) // 2880))
+        ofile.seek(0, os.SEEK_END)
+        copy_extensions(cube, ofile)
+    cube.close()
+
+    # compare in the precision of the data, as a scalar threshold would be
+    tdtype = dtype if dtype.kind == 'f' else np.float64
+    params = {'bscale': bscale,
+              'bzero': bzero,
+              'blank': blank,
+              'dtype': dtype,
+              'snval': (rms*args.SN).astype(tdtype),
+              'snjval': (rms*args.SNJ).astype(tdtype),
+              'nadj': args.spatial}
+    slab = max(args.slab, 1)
+    tasks = [(stokes, lo, min(lo + slab, nchan))
+             for stokes in range(nstokes) for lo in range(0, nchan, slab)]
+    initargs = (args.cube, ofname, len(hstr), params)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                    initargs=initargs)
+        for task in pool.imap_unordered(mask_task, tasks):
+            pass
+        pool.close()
+        pool.join()
+    else:
+        init_worker(*initargs)
+        for task in tasks:
+            mask_task(task)
+        del _worker['out']
+        _worker['cube'].close()
+
+    problems = check_extensions(args.cube, ofname)
+    if problems:
+        sys.stderr.write("ERROR: extensions not copied to "+ofname+": " +
+                         '; '.join(problems)+".\n\n")
+        sys.exit(-1)
@@ -10,13 +10,26 @@
 # --object	desired object
 # --readmode	readout mode (searches a substring)
 # --filter	desired filter (searches FILTER1 and FILTER2)
+# --query	selection query, may be given several times (see below)
+# --index	header keyword cache (default: .fitsindex.db)
+# --threads	number of file headers to read concurrently (default: 8)
 # filelist	list of FITS files to search
 #
 # Usage:
 # luci_select.py [OPTIONS] filelist
+#
+# Queries combine comparisons (=, !=, <, <=, >, >=, ~ for a regular
+# expression, 'in (a,b)' and 'between a and b') with and/or/not, e.g.
+# luci_select.py --query='ITIME>=60 and FILTER in (J,H) and DATE-OBS between 2011-03-01 and 2011-06-30' '*.fits'
+# FILTER matches either of FILTER1 and FILTER2. With several queries, each
+# list is printed after a '# query' line.
 
 import sys,getopt,os,re,glob
-from astropy.io import fits as pyfits
+import mysci
+
+# header keywords kept in the index (so that most queries are answered
+# without opening any files) and the filter keywords
+lucifer=mysci.getInstrument('LUCIFER')
 
 def usage():
   sys.stderr.write('Usage:\n')
@@ -25,7 +38,10 @@ def usage():
   sys.stderr.write('\t--itime=\tintegration time\n')
   sys.stderr.write('\t--object=\tObject name\n')
   sys.stderr.write('\t--readmode=\treadout mode (searches a substring)\n')
-  sys.stderr.write('\t--filter=\tdesired filter (searches FILTER 1 and FILTER2 keywords. EXACT mach needed)\n\n')
+  sys.stderr.write('\t--filter=\tdesired filter (searches FILTER 1 and FILTER2 keywords. EXACT mach needed)\n')
+  sys.stderr.write('\t--query=\tselection query, e.g. "ITIME>=60 and FILTER in (J,H)" (repeatable)\n')
+  sys.stderr.write('\t--index=\theader keyword cache (default: .fitsindex.db)\n')
+  sys.stderr.write('\t--threads=\tnumber of file headers to read concurrently (default: 8)\n\n')
 
 
 ################################################################################
@@ -44,8 +60,8 @@ if re.match('--help',sys.argv[1]) or re.match('-h',sys.argv[1]):
 
 # get the command line arguments
 try:
-  optlist=getopt.getopt(sys.argv[1:],'x',['itime=','object=','readmode=','filter='])
-except getopt.GetoptError, err:
+  optlist=getopt.getopt(sys.argv[1:],'x',['itime=','object=','readmode=','filter=','query=','index=','threads='])
+except getopt.GetoptError as err:
   sys.stderr.write(str(err))
   usage()
   sys.exit(-1)
@@ -56,6 +72,9 @@ files=optlist.pop()
 optlist.append([('foo','null')])	# need it to be at least 2 elements long
 
 args={}
+queries=[]
+dbname='.fitsindex.db'
+threads=8
 for o,a in optlist[0]:
   if o=='--itime':
     args['ITIME']=a
@@ -65,34 +84,56 @@ for o,a in optlist[0]:
     args['READMODE']=a
   elif o=='--filter':
     args['FILTER']=a
+  elif o=='--query':
+    queries.append(a)
+  elif o=='--index':
+    dbname=a
+  elif o=='--threads':
+    threads=int(a)
   else:
     assert False, "unhandled option"
 
+# the individual options are regular expression criteria, applied along
+# with any queries
+criteria=None
+for kw in args.keys():
+  if re.match("FILTER",kw):
+    # re.match() semantics, anchored at the start
+    crit=('~',kw,'^(?:'+args[kw]+')')
+  else:
+    crit=('~',kw,args[kw])
+  if criteria is None:
+    criteria=crit
+  else:
+    criteria=('and',criteria,crit)
+
+try:
+  trees=[mysci.parseQuery(query) for query in queries]
+except ValueError as err:
+  sys.stderr.write('ERROR: '+str(err)+'\n')
+  sys.exit(-1)
+if criteria is not None:
+  trees=[('and',criteria,tree) for tree in trees] or [criteria]
+
 # now crunch through the files
+filelist=[]
 for file1 in files:
   file1=glob.glob(file1)
   for file in file1:
-    match=1
     if os.path.isfile(file):
-      lucif=pyfits.open(file)
-      for kw in args.keys():
-        if re.match("FILTER",kw):
-          # need to search both filter keywords
-          if re.match(args[kw],str(lucif[0].header['FILTER1'])) or re.match(args[kw],str(lucif[0].header['FILTER2'])):
-            match=match*1
-          else:
-            match=match*0
-        else:
-          if re.search(args[kw],str(lucif[0].header[kw])):
-            # we've found the keyword
-            match=match*1
-          else:
-            match=match*0
-      lucif.close()
+      filelist.append(file)
     else:
       sys.stderr.write('ERROR: '+file+' not located, skipping.\n')
-      match=0
 
-    if match:
-      print(file)
+if trees:
+  index=mysci.HeaderIndex(dbname,keywords=lucifer.keywords,threads=threads)
+  selected=index.query(filelist,trees,aliases={'FILTER':lucifer.filterkeys})
+  index.close()
+else:
+  selected=[filelist]   # no criteria given
 
+for query,selection in zip(queries or [None],selected):
+  if len(queries)>1:
+    print('# '+query)
+  for file in selection:
+    print(file)
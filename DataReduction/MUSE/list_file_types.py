@@ -4,25 +4,32 @@
 #
 # Given a list of FITS files, list the types for both processed and raw frames.
 
-import astropy.io.fits as fits
 import argparse
+import mysci
 
 parser = argparse.ArgumentParser()
+parser.add_argument('--index', type=str, default='.fitsindex.db',
+                    help='File to cache header keywords in (default: \
+.fitsindex.db).')
+parser.add_argument('--threads', type=int, default=8,
+                    help='Number of file headers to read concurrently \
+(default: 8).')
 parser.add_argument('fitsfiles', type=str, nargs='+',
                     help='FITS files to sort.')
 args = parser.parse_args()
 
-for entry in args.fitsfiles:
-    myfits = fits.open(entry)
-    try:
-        curr = myfits[0].header['HIERARCH ESO PRO CATG']
-        print(entry + "\tHIERARCH ESO PRO CATG: " + curr)
-    except:
-        curr = False
+index = mysci.HeaderIndex(args.index, threads=args.threads)
+headers = index.headers(args.fitsfiles,
+                        keywords=mysci.getInstrument('MUSE').keywords)
+index.close()
 
-    try:
-        curr = myfits[0].header['ESO DPR CATG']
-        print(entry + "\tESO DPR CATG: " + curr + "\tESO DPR TYPE: " + myfits[0].header['ESO DPR TYPE'])
-    except:
-        curr = False
+for entry in args.fitsfiles:
+    header = headers[entry]
+    if header['HIERARCH ESO PRO CATG'] is not None:
+        print(entry + "\tHIERARCH ESO PRO CATG: " +
+              header['HIERARCH ESO PRO CATG'])
 
+    if header['ESO DPR CATG'] is not None and \
+       header['ESO DPR TYPE'] is not None:
+        print(entry + "\tESO DPR CATG: " + header['ESO DPR CATG'] +
+              "\tESO DPR TYPE: " + header['ESO DPR TYPE'])
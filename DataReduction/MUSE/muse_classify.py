@@ -2,163 +2,242 @@
 #
 # Sort and classify MUSE files.
 
-import astropy.io.fits as fits
 import sys
 import re
+import json
 import argparse
+import mysci
+
+
+# Classification rules. Each group of rules applies to files matching its
+# conditions; within a group the first matching rule wins. Conditions are
+# (keyword, test, value) with the tests:
+#   'search': re.search(value, header value)
+#   'equal': header value == value
+#   'in': header value in the list value
+#   'present': the keyword exists
+# and each rule lists the (sof file, tag) entries the file is written to,
+# where a tag of None means the header value of the rule's first keyword.
+# If no rule of a group matches, its message (if any) is printed.
+
+# frames needed for science post-processing
+files = ['ASTROMETRY_REFERENCE',
+         'ASTROMETRY_WCS',
+         'BADPIX_TABLE',
+         'EXTINCT_TABLE',
+         'FILTER_LIST',
+         'GEOMETRY_TABLE',
+         'LSF_PROFILE',
+         'MASTER_BIAS',
+         'MASTER_FLAT',
+         'MASTER_DARK',
+         'STD_RESPONSE',
+         'STD_TELLURIC',
+         'STD_FLUX_TABLE',
+         'TRACE_TABLE',
+         'TWILIGHT_CUBE',
+         'WAVECAL_TABLE']
+# frames needed for preprocessing
+preproc = ['GEOMETRY_TABLE',
+           'BADPIX_TABLE',
+           'MASTER_BIAS',
+           'MASTER_FLAT',
+           'TRACE_TABLE',
+           'WAVECAL_TABLE']
+# frames needed to create a sky frame
+skyf = ['EXTINCT_TABLE',
+        'STD_RESPONSE',
+        'SKY_LINES',
+        'LSF_PROFILE',
+        'STD_TELLURIC']
+
+processed_rules = [
+    ([('HIERARCH ESO PRO CATG', 'present', None)],
+     [([('HIERARCH ESO PRO CATG', 'in', skyf)], [('sky.sof', None)]),
+      ([('HIERARCH ESO PRO CATG', 'in', preproc)],
+       [('sky-pre.sof', None), ('object-pre.sof', None)]),
+      ([('HIERARCH ESO PRO CATG', 'in', files)], [('scipost.sof', None)])],
+     None),
+    ([('ESO DPR CATG', 'search', 'SCIENCE')],
+     [([('ESO DPR TYPE', 'search', 'SKY')], [('sky-pre.sof', 'SKY')]),
+      ([('ESO DPR TYPE', 'search', 'OBJECT')],
+       [('object-pre.sof', 'OBJECT')])],
+     None)]
+processed_sofs = ['object-pre.sof', 'scipost.sof', 'sky.sof', 'sky-pre.sof']
+
+# the more specific DPR TYPEs have to come first, e.g. 'FLAT,LAMP,ILLUM'
+# before 'FLAT,LAMP'
+raw_rules = [
+    ([('ESO DPR CATG', 'search', 'CALIB'), ('ESO DPR TYPE', 'present', None)],
+     [([('ESO DPR TYPE', 'search', 'BIAS')], [('bias.sof', 'BIAS')]),
+      ([('ESO DPR TYPE', 'search', 'DARK')], [('dark.sof', 'DARK')]),
+      ([('ESO DPR TYPE', 'search', 'FLAT,LAMP,ILLUM')],
+       [('illum.sof', 'FLAT,LAMP,ILLUM')]),
+      ([('ESO DPR TYPE', 'search', 'FLAT,LAMP')], [('flat.sof', 'FLAT')]),
+      ([('ESO DPR TYPE', 'search', 'FLAT,SKY')],
+       [('skyflat.sof', 'SKYFLAT')]),
+      ([('ESO DPR TYPE', 'search', 'WAVE,MASK')],
+       [('mask.sof', 'WAVE,MASK')]),
+      ([('ESO DPR TYPE', 'search', 'WAVE')],
+       [('wave.sof', 'ARC'), ('lsf.sof', 'ARC')]),
+      ([('ESO DPR TYPE', 'search', 'STD')], [('std.sof', 'STD')]),
+      ([('ESO DPR TYPE', 'search', 'ASTROMETRY')],
+       [('astrometry.sof', 'ASTROMETRY')])],
+     'not recognized as a calib file.'),
+    ([('ESO DPR CATG', 'equal', 'SCIENCE'), ('ESO DPR TYPE', 'present', None)],
+     [([('ESO DPR TYPE', 'equal', 'SKY')], [('sky.sof', 'SKY')]),
+      ([('ESO DPR TYPE', 'equal', 'OBJECT')], [('object.sof', 'OBJECT')])],
+     'not recognized as a science file.')]
+raw_sofs = ['bias.sof', 'dark.sof', 'flat.sof', 'skyflat.sof', 'wave.sof',
+            'lsf.sof', 'mask.sof', 'std.sof', 'astrometry.sof', 'sky.sof',
+            'object.sof', 'illum.sof']
+
+
+def compileCondition(keyword, test, value):
+    """
+    Turn a rule condition into a function of the header dictionary.
+    """
+
+    if test == 'search':
+        pattern = re.compile(value)
+        return lambda header: header.get(keyword) is not None and \
+            pattern.search(str(header[keyword])) is not None
+    elif test == 'equal':
+        return lambda header: header.get(keyword) == value
+    elif test == 'in':
+        values = set(value)
+        return lambda header: header.get(keyword) in values
+    elif test == 'present':
+        return lambda header: header.get(keyword) is not None
+    raise ValueError('Unknown rule test: ' + test)
+
+
+def compileRules(rules):
+    """
+    Compile a rule table, returning the compiled groups and the header
+    keywords the rules need.
+    """
+
+    keywords = []
+    compiled = []
+    for conditions, group, message in rules:
+        for keyword, test, value in conditions + \
+                [cond for rule in group for cond in rule[0]]:
+            if not(keyword in keywords):
+                keywords.append(keyword)
+        compiled.append(([compileCondition(*cond) for cond in conditions],
+                         [([compileCondition(*cond) for cond in rule],
+                           outputs, rule[0][0])
+                          for rule, outputs in group],
+                         message))
+    return compiled, keywords
+
+
+def classify(header, compiled):
+    """
+    Classify one file, returning a list of (sof file, tag) entries and a
+    list of messages for rule groups that did not recognize the file.
+    """
+
+    entries = []
+    messages = []
+    for conditions, group, message in compiled:
+        if not(all(cond(header) for cond in conditions)):
+            continue
+        for tests, outputs, first in group:
+            if all(test(header) for test in tests):
+                entries.extend((sof, tag if tag is not None else
+                                str(header[first]))
+                               for sof, tag in outputs)
+                break
+        else:
+            if message:
+                messages.append(message)
+    return entries, messages
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p','--processed', type=bool, default=False,
                     help='Invoke if using pre-processed calibrations.')
+parser.add_argument('-n', '--dry-run', action='store_true', default=False,
+                    help='Classify the files without writing .sof files.')
+parser.add_argument('--json', type=str, default=None,
+                    help='Write the classification of each file to this \
+JSON file ("-" for standard output), e.g. to compare runs.')
+parser.add_argument('--index', type=str, default='.fitsindex.db',
+                    help='File to cache header keywords in (default: \
+.fitsindex.db).')
+parser.add_argument('--threads', type=int, default=8,
+                    help='Number of file headers to read concurrently \
+(default: 8).')
 parser.add_argument('fitsfiles', type=str, nargs='+',
                     help='FITS files to sort.')
 args = parser.parse_args()
 
-sys.stdout.write('Sorting ' + str(len(args.fitsfiles)) + ' FITS files.\n')
+# messages go to stderr if the summary is written to stdout
+out = sys.stdout
+if args.json == '-':
+    out = sys.stderr
+
+out.write('Sorting ' + str(len(args.fitsfiles)) + ' FITS files.\n')
 
 if args.processed:
-    sys.stdout.write('Assuming files contain processed calibrations.\n')
-    # frames needed for science post-processing
-    files = [
-             'ASTROMETRY_REFERENCE',
-             'ASTROMETRY_WCS',
-             'BADPIX_TABLE',
-             'EXTINCT_TABLE',
-             'FILTER_LIST',
-             'GEOMETRY_TABLE',
-             'LSF_PROFILE',
-             'MASTER_BIAS',
-             'MASTER_FLAT',
-             'MASTER_DARK',
-             'STD_RESPONSE',
-             'STD_TELLURIC',
-             'STD_FLUX_TABLE',
-             'STD_RESPONSE',
-             'STD_TELLURIC',
-             'TRACE_TABLE',
-             'TWILIGHT_CUBE',
-             'WAVECAL_TABLE']
-    # frames needed for preprocessing
-    preproc = ['GEOMETRY_TABLE',
-               'BADPIX_TABLE',
-               'MASTER_BIAS',
-               'MASTER_FLAT',
-               'TRACE_TABLE',
-               'WAVECAL_TABLE']
-    # frames needed to create a sky frame
-    skyf = ['EXTINCT_TABLE',
-            'STD_RESPONSE',
-            'SKY_LINES',
-            'LSF_PROFILE',
-            'STD_TELLURIC']
-
-    objp = open('object-pre.sof', 'w')
-    spost = open('scipost.sof', 'w')
-    sky = open('sky.sof', 'w')
-    skyp = open('sky-pre.sof', 'w')
-
-    for entry in args.fitsfiles:
-        myfits = fits.open(entry)
-        try:
-            curr = myfits[0].header['HIERARCH ESO PRO CATG']
-        except:
-            curr = False
-        if curr:
-            if curr in skyf:
-                sky.write(entry + ' ' + curr + '\n')
-            elif curr in preproc:
-                skyp.write(entry + ' ' + curr + '\n')
-                objp.write(entry + ' ' + curr + '\n')
-            elif curr in files:
-                spost.write(entry + ' ' + curr + '\n')
-        try:
-            curr = myfits[0].header['ESO DPR CATG']
-        except:
-            curr = False
-        if curr and re.search('SCIENCE', curr):
-            curr = myfits[0].header['ESO DPR TYPE']
-            if re.search('SKY', curr):
-                #sky.write(entry + ' SKY\n')
-                skyp.write(entry + ' SKY\n')
-            elif re.search('OBJECT', curr):
-                #spost.write(entry + ' OBJECT\n')
-                objp.write(entry + ' OBJECT\n')
-    objp.close()
-    spost.close()
-    sky.close()
-    skyp.close()
-
-    sys.stdout.write('Finished writing files. Now, pre-process sky \
-and object frames with the following commands:\n\n')
-    sys.stdout.write('OMP_NUM_THREADS=4 esorex --log-file=sky-pre.log muse_scibasic --nifu=-1 --merge sky-pre.sof\n\n')
-    sys.stdout.write('OMP_NUM_THREADS=4 esorex --log-file=object-pre.log muse_scibasic --nifu=-1 --merge object-pre.sof\n\n')
-    sys.stdout.write('Then add the PIXTABLE_SKY files to sky.sof, append "PIXTABLE_SKY", and run:\n\n')
-    sys.stdout.write('OMP_NUM_THREADS=4 esorex --log-file=makesky.log muse_create_sky sky.sof\n\n')
-    sys.stdout.write('Finally add the PIXTABLE_OBJECT files to scipost.sof, append "PIXTABLE_OBJECT", and run:\n\n')
-    sys.stdout.write('OMP_NUM_THREADS=4 esorex --log-file=scipost.log muse_scipost scipost.sof\n\n')
+    out.write('Assuming files contain processed calibrations.\n')
+    compiled, keywords = compileRules(processed_rules)
+    sofs = processed_sofs
+else:
+    out.write('Cataloging files using raw calibration frames.\n')
+    compiled, keywords = compileRules(raw_rules)
+    sofs = raw_sofs
+
+# each header is read (at most) once, the keywords are cached in the index
+# along with the standard MUSE ones
+muse = mysci.getInstrument('MUSE')
+index = mysci.HeaderIndex(args.index, threads=args.threads)
+headers = index.refresh(args.fitsfiles, keywords=muse.keywords +
+                        [kw for kw in keywords if kw not in muse.keywords])
+index.close()
 
+sofentries = dict((sof, []) for sof in sofs)
+summary = {}
+for entry, header in headers:
+    if header is None:
+        sys.stderr.write(entry + ' could not be read.\n')
+        summary[entry] = None
+        continue
+    entries, messages = classify(header, compiled)
+    for message in messages:
+        sys.stderr.write(entry + ' ' + message + '\n')
+    for sof, tag in entries:
+        sofentries[sof].append(entry + ' ' + tag + '\n')
+    summary[entry] = [sof + ' ' + tag for sof, tag in entries]
+
+if not(args.dry_run):
+    for sof in sofs:
+        with open(sof, 'w') as f:
+            f.writelines(sofentries[sof])
+
+if args.json == '-':
+    json.dump(summary, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write('\n')
+elif args.json:
+    with open(args.json, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+for sof in sofs:
+    out.write('\t' + sof + ': ' + str(len(sofentries[sof])) + ' files\n')
+
+if args.dry_run:
+    out.write('Dry run, no .sof files written.\n')
+elif args.processed:
+    out.write('Finished writing files. Now, pre-process sky \
+and object frames with the following commands:\n\n')
+    out.write('OMP_NUM_THREADS=4 esorex --log-file=sky-pre.log muse_scibasic --nifu=-1 --merge sky-pre.sof\n\n')
+    out.write('OMP_NUM_THREADS=4 esorex --log-file=object-pre.log muse_scibasic --nifu=-1 --merge object-pre.sof\n\n')
+    out.write('Then add the PIXTABLE_SKY files to sky.sof, append "PIXTABLE_SKY", and run:\n\n')
+    out.write('OMP_NUM_THREADS=4 esorex --log-file=makesky.log muse_create_sky sky.sof\n\n')
+    out.write('Finally add the PIXTABLE_OBJECT files to scipost.sof, append "PIXTABLE_OBJECT", and run:\n\n')
+    out.write('OMP_NUM_THREADS=4 esorex --log-file=scipost.log muse_scipost scipost.sof\n\n')
 else:
-    sys.stdout.write('Cataloging files using raw calibration frames.\n')
-
-    bias = open('bias.sof', 'w')
-    dark = open('dark.sof', 'w')
-    flat = open('flat.sof', 'w')
-    skyflat = open('skyflat.sof', 'w')
-    wave = open('wave.sof', 'w')
-    lsf = open('lsf.sof', 'w')
-    mask = open('mask.sof', 'w')
-    std = open('std.sof', 'w')
-    astro = open('astrometry.sof', 'w')
-    sky = open('sky.sof', 'w')
-    obj = open('object.sof', 'w')
-    illum = open('illum.sof', 'w')
-    
-    for entry in args.fitsfiles:
-        myfits = fits.open(entry)
-        if 'ESO DPR CATG' in list(myfits[0].header.keys()) and \
-           'ESO DPR TYPE' in list(myfits[0].header.keys()):
-            if re.search('CALIB', myfits[0].header['ESO DPR CATG']):
-                if re.search('BIAS', myfits[0].header['ESO DPR TYPE']):
-                    bias.write(entry + ' BIAS\n')
-                elif re.search('DARK', myfits[0].header['ESO DPR TYPE']):
-                    dark.write(entry + ' DARK\n')
-                elif re.search('FLAT,LAMP',myfits[0].header['ESO DPR TYPE']):
-                    flat.write(entry + ' FLAT\n')
-                elif re.search('FLAT,SKY', myfits[0].header['ESO DPR TYPE']):
-                    skyflat.write(entry + ' SKYFLAT\n')
-                elif re.search('WAVE', myfits[0].header['ESO DPR TYPE']):
-                    wave.write(entry + ' ARC\n')
-                    lsf.write(entry + ' ARC\n')
-                elif re.search('WAVE,MASK', myfits[0].header['ESO DPR TYPE']):
-                    mask.write(entry + ' WAVE,MASK\n')
-                elif re.search('STD', myfits[0].header['ESO DPR TYPE']):
-                    std.write(entry + ' STD\n')
-                elif re.search('ASTROMETRY', myfits[0].header['ESO DPR TYPE']):
-                    astro.write(entry + ' ASTROMETRY\n')
-                elif re.search('FLAT,LAMP,ILLUM', myfits[0].header['ESO DPR TYPE']):
-                    illum.write(entry + ' FLAT,LAMP,ILLUM\n')
-                else:
-                    sys.stderr.write(entry + ' not recognized as a calib file.\n')
-            elif myfits[0].header['ESO DPR CATG'] == 'SCIENCE':
-                if myfits[0].header['ESO DPR TYPE'] == 'SKY':
-                    sky.write(entry + ' SKY\n')
-                elif myfits[0].header['ESO DPR TYPE'] == 'OBJECT':
-                    obj.write(entry + ' OBJECT\n')
-                else:
-                    sys.stderr.write(entry + ' not recognized as a science file.\n')
-    
-    bias.close()
-    dark.close()
-    flat.close()
-    skyflat.close()
-    wave.close()
-    lsf.close()
-    mask.close()
-    std.close()
-    astro.close()
-    sky.close()
-    obj.close()
-    illum.close()
-
-    sys.stdout.write('Finished sorting the raw files.\n')
+    out.write('Finished sorting the raw files.\n')
@@ -4,13 +4,14 @@
 #
 # Fix headers of FITS files for VATT observations.
 
-import pyfits
+from astropy.io import fits as pyfits
 import sys
 import os
 import re
 import glob
 import getopt
 import datetime
+import mysci
 
 
 def usage():
@@ -18,8 +19,10 @@ def usage():
     sys.stderr.write(sys.argv[0] + ' [OPTIONS] filelist\n\n')
     sys.stderr.write('Acceptable options are:\n')
     sys.stderr.write('\t--observer=\tobserverstring\n')
-    sys.stderr.write('\t--filter=\tFilter String\t\t(only applied to object
-                     and flat files)\n')
+    sys.stderr.write('\t--filter=\tFilter String\t\t(only applied to object \
+and flat files)\n')
+    sys.stderr.write('\t--index=\theader keyword cache (default: \
+.fitsindex.db)\n')
 
 
 if len(sys.argv) < 2:
@@ -29,8 +32,8 @@ if len(sys.argv) < 2:
 
 # get the command line arguments
 try:
-    optlist = getopt.getopt(sys.argv[1:], 'x', ['observer=', 'filter='])
-except getopt.GetoptError, err:
+    optlist = getopt.getopt(sys.argv[1:], 'x', ['observer=', 'filter=', 'index='])
+except getopt.GetoptError as err:
     sys.stderr.write(str(err))
     usage()
     sys.exit(-1)
@@ -41,48 +44,69 @@ files = optlist.pop()
 optlist.append([('foo', 'null')])   # need it to be at least 2 elements long
 
 args = {}
+dbname = '.fitsindex.db'
 for o, a in optlist[0]:
     if o == '--observer':
         args['OBSERVER'] = a
     elif o == '--filter':
         args['FILTER'] = a
+    elif o == '--index':
+        dbname = a
     else:
         assert False, "unhandled option"
 
+# header keywords for VATT frames
+vatt = mysci.getInstrument('VATT')
+IMGKEY = vatt.imgkey
+FILTKEY = vatt.filterkeys[0]
+
 # get the current date and time (for the purposes of the history keywords)
 datenow = datetime.datetime.today().isoformat()
 
-# now crunch through the files and change the header keywords
+# find the frames to fix from the (cached) image types, so that files
+# which do not need changes are not opened
+fixfiles = []
 for file1 in files:
-    file1 = glob.glob(file1)
-    for file in file1:
-        if os.path.isfile(file):
-            frame = pyfits.open(file, mode='update')
-            sys.stderr.write('Opened ' + frame.filename() + '\t- ')
-            if 'OBSERVER' in args.keys():   # replace the observer keyword
-                sys.stderr.write('Fixing OBSERVER keyword...\t')
-                frame[0].header.update('OBSERVER', args['OBSERVER'])
-                frame[0].header.add_history(datenow +
-                                            ' - Corrected OBSERVER keyword.')
-            # only replace the filter for object or flat frames
-            if 'FILTER' in args.keys() and \
-                    (re.match('object', frame[0].header['IMAGETYP']) or
-                     re.match('flat', frame[0].header['IMAGETYP'])):
-                oldfilt = 0
-                # replace the filter keyword
-                if 'FILTER' in frame[0].header.keys():
-                    oldfilt = frame[0].header['FILTER']
-                    frame[0].header.update('FILTER', args['FILTER'])
-                if oldfilt:
-                    frame[0].header.add_history(datenow +
-                                                ' - Changed FILTER keyword \
-                                                from ' + oldfilt + ' to '
-                                                + args['FILTER'])
-                    sys.stderr.write('FILTER keyword updated...\t')
-                else:
-                    frame[0].header.add_history(datenow +
-                                                ' - FILTER keyword added.')
-                    sys.stderr.write('FILTER keyword added...\t')
-            # our work here is done, close the frame.
-            frame.close()
-            sys.stderr.write('File closed.\n')
+    fixfiles.extend(file for file in glob.glob(file1) if os.path.isfile(file))
+index = mysci.HeaderIndex(dbname)
+if not('OBSERVER' in args.keys()):
+    if 'FILTER' in args.keys():
+        # only object and flat frames get the new filter
+        fixfiles = index.select(fixfiles, {IMGKEY: '^(object|flat)'})
+    else:
+        fixfiles = []
+
+# now crunch through the files and change the header keywords
+for file in fixfiles:
+    frame = pyfits.open(file, mode='update')
+    sys.stderr.write('Opened ' + frame.filename() + '\t- ')
+    if 'OBSERVER' in args.keys():   # replace the observer keyword
+        sys.stderr.write('Fixing OBSERVER keyword...\t')
+        frame[0].header['OBSERVER'] = args['OBSERVER']
+        frame[0].header.add_history(datenow +
+                                    ' - Corrected OBSERVER keyword.')
+    # only replace the filter for object or flat frames
+    if 'FILTER' in args.keys() and \
+            (re.match('object', frame[0].header[IMGKEY]) or
+             re.match('flat', frame[0].header[IMGKEY])):
+        oldfilt = 0
+        # replace the filter keyword
+        if FILTKEY in frame[0].header.keys():
+            oldfilt = frame[0].header[FILTKEY]
+        frame[0].header[FILTKEY] = args['FILTER']
+        if oldfilt:
+            frame[0].header.add_history(datenow +
+                                        ' - Changed FILTER keyword from ' +
+                                        oldfilt + ' to ' + args['FILTER'])
+            sys.stderr.write('FILTER keyword updated...\t')
+        else:
+            frame[0].header.add_history(datenow +
+                                        ' - FILTER keyword added.')
+            sys.stderr.write('FILTER keyword added...\t')
+    # our work here is done, close the frame.
+    frame.close()
+    sys.stderr.write('File closed.\n')
+
+# the headers changed, record them now rather than on the next run
+index.refresh(fixfiles, keywords=vatt.keywords + ['OBSERVER'])
+index.close()
@@ -6,56 +6,215 @@
 # data or a comparison file
 
 import glob
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits as pyfits
 
 
-def hicomp(files, compfile=False, hrange=(0, 65000), corrfac=1):
+def imageExtensions(frame):
+    """
+    Return the indices of the HDUs of an open FITS file holding images.
+    """
+    return [i for i, hdu in enumerate(frame)
+            if hdu.is_image and hdu.header.get('NAXIS', 0) > 0]
+
+
+def extHistogram(hdu, bins=100, hrange=(0, 65000), corrfac=1, chunk=1 << 22):
+    """
+    Histogram the (BZERO/BSCALE scaled, times corrfac) values of an image
+    HDU, opened with do_not_scale_image_data=True, into bins fixed bins over
+    hrange, as np.histogram() would. Values outside hrange, NaNs and BLANK
+    pixels are not counted.
+
+    The data are read chunk pixels at a time, so memory-mapped data are never
+    copied (or scaled) as a whole. 8 and 16 bit integer data are counted per
+    raw value with np.bincount() and only the distinct values are binned.
+    """
+
+    data = hdu.data
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    blank = hdu.header.get('BLANK') if data.dtype.kind in 'iu' else None
+    counts = np.zeros(bins, dtype=np.int64)
+    rows = max(1, chunk // max(1, data[0].size)) if data.ndim > 1 else chunk
+    if data.dtype.kind in 'iu' and data.dtype.itemsize <= 2:
+        # count each raw value, then bin the values
+        offset = np.iinfo(data.dtype).min
+        nvals = 1 << (8 * data.dtype.itemsize)
+        vcounts = np.zeros(nvals, dtype=np.int64)
+        for start in range(0, len(data), rows):
+            raw = np.ravel(data[start:start+rows]).astype(np.int32)
+            if offset:
+                raw -= offset
+            vcounts += np.bincount(raw, minlength=nvals)
+        if blank is not None:
+            vcounts[blank - offset] = 0
+        used = np.nonzero(vcounts)[0]
+        values = ((used + offset) * bscale + bzero) * corrfac
+        return np.histogram(values, bins, range=hrange,
+                            weights=vcounts[used])[0].astype(np.int64)
+
+    for start in range(0, len(data), rows):
+        values = np.ravel(data[start:start+rows])
+        if blank is not None:
+            values = values[values != blank]
+        if bscale != 1 or bzero != 0 or corrfac != 1:
+            values = (values * np.float64(bscale) + bzero) * corrfac
+        counts += np.histogram(values, bins, range=hrange)[0]
+    return counts
+
+
+def fileHistograms(fname, bins=100, hrange=(0, 65000), corrfac=1):
+    """
+    Return the histograms (next, bins) of the image extensions of a file.
+    """
+    with pyfits.open(fname, do_not_scale_image_data=True) as frame:
+        return np.array([extHistogram(frame[i], bins=bins, hrange=hrange,
+                                      corrfac=corrfac)
+                         for i in imageExtensions(frame)], dtype=np.int64)
+
+
+def histograms(files, bins=100, hrange=(0, 65000), corrfac=1):
+    """
+    Return the histograms of a list of files in one (nfiles, next, bins)
+    array, and the bin edges. The files must have the same number of image
+    extensions.
+    """
+    counts = [fileHistograms(fname, bins=bins, hrange=hrange, corrfac=corrfac)
+              for fname in files]
+    if len(set(c.shape for c in counts)) > 1:
+        raise ValueError('Files have different numbers of image extensions.')
+    counts = np.array(counts, dtype=np.int64).reshape((len(files), -1, bins))
+    return counts, np.linspace(hrange[0], hrange[1], bins + 1)
+
+
+def saveHistograms(fname, edges, files, **counts):
+    """
+    Save histograms (arrays from histograms(), by name) with their bin edges
+    and file list to a .npz file.
+    """
+    np.savez(fname, edges=edges, files=np.array(files), **counts)
+
+
+def loadHistograms(fname):
+    """
+    Load histograms saved by saveHistograms(), as a dictionary of arrays.
+    """
+    with np.load(fname) as hists:
+        return dict(hists)
+
+
+def moments(counts, edges):
+    """
+    Return the number of values, mean, standard deviation and skewness of
+    histograms (along the last axis of counts), from the bin centers.
+    """
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    n = counts.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (counts * centers).sum(axis=-1) / n
+        dev = centers - mean[..., np.newaxis]
+        var = (counts * dev**2).sum(axis=-1) / n
+        skew = (counts * dev**3).sum(axis=-1) / n / var**1.5
+    return n, mean, np.sqrt(var), skew
+
+
+def ksDistance(counts1, counts2):
+    """
+    Return the Kolmogorov-Smirnov distance (largest difference of the
+    normalized cumulative distributions) between histograms, along the last
+    axis.
+    """
+    cdf1 = np.cumsum(counts1, axis=-1, dtype=np.float64)
+    cdf2 = np.cumsum(counts2, axis=-1, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cdf1 /= cdf1[..., -1:]
+        cdf2 /= cdf2[..., -1:]
+    return np.abs(cdf1 - cdf2).max(axis=-1)
+
+
+def hicomp(files, compfile=False, hrange=(0, 65000), corrfac=1, bins=100,
+           save=None, plot=True):
+    """
+    Compare the histograms of each file (red) to its calibrated version
+    (file-bsub_flat.fits) or to compfile (blue, times corrfac), saving a
+    plot per file as file.png and optionally all histograms to save (.npz).
+
+    Returns the bin edges, the histograms of the files and of the
+    comparison frames, each (nfiles, next, bins).
+    """
 
     # get the flie list
     files = glob.glob(files)
     # sort it
     files.sort()
     if compfile:
-        # load the compfile, compare *everything* to this
-        frame = pyfits.open(compfile)
-        comp = True
+        # compare *everything* to this
+        compfiles = [compfile]
+        comps = [compfile] * len(files)
     else:
-        comp = False
-    # continue comparing stuff
-    j = 0   # keep track of how many comparisons we've made
-    for file in files:
+        compfiles = [fname.split('.fits')[0] + '-bsub_flat.fits'
+                     for fname in files]
+        comps = compfiles
+    counts, edges = histograms(files, bins=bins, hrange=hrange)
+    ccounts = histograms(compfiles, bins=bins, hrange=hrange,
+                         corrfac=corrfac)[0]
+    if compfile:
+        ccounts = np.repeat(ccounts, len(files), axis=0)
+    if counts.shape != ccounts.shape:
+        # frames must have the same number of extensions for this to work!
+        raise ValueError('Files and comparison frames have different numbers \
+of image extensions.')
+
+    ks = ksDistance(counts, ccounts)
+    for j, fname in enumerate(files):
+        print(fname + ' vs ' + comps[j] + ': largest KS distance ' +
+              '{0:.4f}'.format(np.nanmax(ks[j])))
+        if not(plot):
+            continue
         plt.figure(j)
         plt.xlabel('Counts')
         plt.ylabel('Number')
-        frame2 = pyfits.open(file)
-        if not(comp):
-            frame = pyfits.open(file.split('.fits')[0] + '-bsub_flat.fits')
-            plt.title(file + '-' + file.split('.fits')[0] + '-bsub_flat.fits')
-        else:
-            plt.title(file+' and ' + compfile)
-        for i in range(1, len(frame)):  # frames must have the same number of
-                    # extensions for this to work!
+        plt.title(fname + ' and ' + comps[j])
+        for i in range(counts.shape[1]):
             # uncorrected data
-            (a, b, c) = plt.hist(np.ravel(frame2[i].data), 100, range=hrange,
-                                 alpha=0.3, color='red')
+            plt.stairs(counts[j, i], edges, fill=True, alpha=0.3,
+                       color='red')
             # corrected data
-            (a, b, c) = plt.hist(np.ravel(frame[i].data*corrfac), 100,
-                                 range=hrange, alpha=0.3, color='blue')
-        frame2.close()
-        if not(comp):
-            frame.close()
-        print("Saving figure #" + str(j) + ", " + file.split('.fits')[0] + \
+            plt.stairs(ccounts[j, i], edges, fill=True, alpha=0.3,
+                       color='blue')
+        print("Saving figure #" + str(j) + ", " + fname.split('.fits')[0] +
               '.png')
-        plt.savefig(file.split('.fits')[0] + '.png', format='png')
-        j = j+1
+        plt.savefig(fname.split('.fits')[0] + '.png', format='png')
+        plt.close(j)
+
+    if save:
+        saveHistograms(save, edges, files, counts=counts, comp=ccounts)
+
+    return edges, counts, ccounts
 
-    if comp:
-        frame.close()
 
-    # delete unused variables
-    del a, b, c
-    del frame, frame2
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare histograms of raw \
+frames with their calibrated versions (file-bsub_flat.fits) or a comparison \
+file.')
+    parser.add_argument('files', help='glob pattern of the files to compare')
+    parser.add_argument('--compfile', action='store', default=False,
+                        help='Compare all files to this file instead.')
+    parser.add_argument('--range', action='store', type=float, nargs=2,
+                        default=(0, 65000), help='Histogram range \
+(default: 0 65000).')
+    parser.add_argument('--bins', action='store', type=int, default=100,
+                        help='Number of histogram bins (default: 100).')
+    parser.add_argument('--corrfac', action='store', type=float, default=1,
+                        help='Factor to multiply the comparison data by.')
+    parser.add_argument('--save', action='store', default=None,
+                        help='Save the histograms to this .npz file.')
+    parser.add_argument('--noplot', action='store_true', default=False,
+                        help='Do not plot the histograms.')
+    args = parser.parse_args()
 
-    return 0
+    hicomp(args.files, compfile=args.compfile, hrange=tuple(args.range),
+           corrfac=args.corrfac, bins=args.bins, save=args.save,
+           plot=not(args.noplot))
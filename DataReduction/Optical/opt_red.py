@@ -10,51 +10,260 @@ import sys
 import os
 import re
 import glob
+import json
 import shutil
+import hashlib
+import tempfile
 import datetime
+import time
+import concurrent.futures
 import matplotlib.pyplot as plt
 import mysci
 import argparse
 
 
-def imageCombine(imgnames, frametype, sigma=3, subimage=None, normed=False,
-                 verbose=False):
+def sigmaClip(sdata, sigma=3, maxiter=5):
     """
-    Take a list of images, perform a specified combination operation and
-    return the final image. Optionally provide diagnostic feedback.
+    Iterative per-pixel sigma-clipped mean of sdata (npix, nframes), which
+    must already be sorted along the frame axis.
+
+    Clipping always removes values from the ends of the sorted list, so each
+    iteration only moves the per-pixel lower/upper limits. Values more than
+    sigma standard deviations from the median of the remaining values are
+    rejected. NaNs (sorted to the end) are ignored.
+    """
+    npix, nframes = sdata.shape
+    good = ~np.isnan(sdata)
+    # cumulative sums give the mean and variance of any kept range
+    csum = np.zeros((npix, nframes + 1))
+    csum2 = np.zeros((npix, nframes + 1))
+    vals = np.where(good, sdata, 0.)
+    np.cumsum(vals, axis=1, out=csum[:, 1:])
+    np.cumsum(vals * vals, axis=1, out=csum2[:, 1:])
+    del vals
+    lo = np.zeros((npix, 1), dtype=np.intp)
+    hi = good.sum(axis=1, keepdims=True)
+    for i in range(maxiter):
+        count = np.maximum(hi - lo, 1)
+        mid = lo + (count - 1) // 2
+        med = 0.5 * (np.take_along_axis(sdata, mid, axis=1) +
+                     np.take_along_axis(sdata, mid + (count + 1) % 2, axis=1))
+        total = (np.take_along_axis(csum, hi, axis=1) -
+                 np.take_along_axis(csum, lo, axis=1))
+        total2 = (np.take_along_axis(csum2, hi, axis=1) -
+                  np.take_along_axis(csum2, lo, axis=1))
+        std = np.sqrt(np.maximum(total2 / count - (total / count)**2, 0))
+        newlo = np.maximum(lo, (sdata < (med - sigma * std)).sum(
+            axis=1, keepdims=True))
+        newhi = np.minimum(hi, (sdata <= (med + sigma * std)).sum(
+            axis=1, keepdims=True))
+        # never reject everything
+        keep = newhi > newlo
+        newlo = np.where(keep, newlo, lo)
+        newhi = np.where(keep, newhi, hi)
+        if np.array_equal(newlo, lo) and np.array_equal(newhi, hi):
+            break
+        lo = newlo
+        hi = newhi
+    total = (np.take_along_axis(csum, hi, axis=1) -
+             np.take_along_axis(csum, lo, axis=1))
+    return np.where(hi > lo, total / np.maximum(hi - lo, 1), np.nan)[:, 0]
+
+
+def combineBand(data, method='global', sigma=3, weights=None, nlow=1,
+                nhigh=1, center=0., spread=np.inf):
+    """
+    Combine a (nframes, npix) band of a frame stack along the frame axis.
+
+    Methods:
+      global: mean, rejecting values more than sigma*spread above center
+              (the stack-wide mean and standard deviation)
+      sigclip: iterative per-pixel sigma-clipped mean
+      median: per-pixel median
+      minmax: mean after rejecting the nlow lowest and nhigh highest values
+      wmean: mean weighted by weights (e.g., exposure times)
+    """
+    nframes = data.shape[0]
+    if method == 'global':
+        keep = ~((data - center) > (sigma * spread))
+        count = keep.sum(axis=0)
+        total = np.where(keep, data, 0).sum(axis=0, dtype=np.float64)
+        # fall back to the unclipped mean if every frame was rejected
+        return np.where(count > 0, total / np.maximum(count, 1),
+                        data.mean(axis=0, dtype=np.float64))
+    elif method == 'wmean':
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.sum() == 0:
+            # e.g. bias frames, with EXPTIME = 0
+            return data.mean(axis=0, dtype=np.float64)
+        return np.tensordot(weights, data, axes=1) / weights.sum()
+    elif method not in ('sigclip', 'median', 'minmax'):
+        raise ValueError('Unknown combination method: ' + str(method))
+
+    # the order statistics are computed pixel-major, so each pixel's values
+    # are contiguous; sorting them is faster than partitioning along axis 0
+    sdata = np.sort(np.ascontiguousarray(data.T), axis=1)
+    if method == 'minmax' and nlow + nhigh >= nframes:
+        sys.stderr.write('Too few frames for min/max rejection, using the \
+median.\n')
+        method = 'median'
+    if method == 'sigclip':
+        return sigmaClip(sdata.astype(np.float64), sigma=sigma)
+
+    # NaNs are sorted to the end, so each pixel's values are the first count
+    count = (~np.isnan(sdata)).sum(axis=1, keepdims=True)
+    lower = np.take_along_axis(sdata, np.maximum(count - 1, 0) // 2, axis=1)
+    upper = np.take_along_axis(sdata, np.minimum(count // 2, nframes - 1),
+                               axis=1)
+    median = np.where(count > 0, 0.5 * (lower.astype(np.float64) + upper),
+                      np.nan)[:, 0]
+    if method == 'median':
+        return median
+    # mean of the kept range of each pixel, from cumulative sums as in
+    # sigmaClip(); pixels with too few values get their median
+    csum = np.zeros((sdata.shape[0], nframes + 1))
+    np.cumsum(np.where(np.isnan(sdata), 0, sdata), axis=1, out=csum[:, 1:])
+    hi = np.maximum(count - nhigh, nlow)
+    total = (np.take_along_axis(csum, hi, axis=1) - csum[:, nlow:nlow+1])[:, 0]
+    kept = (hi - nlow)[:, 0]
+    return np.where(kept > 0, total / np.maximum(kept, 1), median)
+
+
+def loadStack(imgnames, subimage=None, scratch=None, keep=True):
+    """
+    Load a list of images into a preallocated (nframes, ...) stack.
 
     Arguments:
-      imgnames: ist or tuple of images to combine
-      frametype: type of image, for the file name and output
-      sigma: what sigma to use for sigma-clipping (default: 3)
-      subimage: image to subtract from all frames before processing
-      normed: normalize output file to 1? (default: False)
-      verbse: extra diagnostic output
+      imgnames: list or tuple of images to load
+      subimage: image to subtract from all frames
+      scratch: if set, the stack is memory-mapped to a temporary file in this
+               directory instead of being held in memory
+      keep: if False, only the per-frame statistics are computed, one frame
+            at a time, and no stack is returned (None)
+
+    Returns the stack, lists of the per-frame mean, median and standard
+    deviation, and the list of exposure times.
     """
-    
+    exptime = []
     mean = []
     median = []
     stddev = []
-    cframes = np.array([0])
-    for image in imgnames:
-        idata = mysci.Telload(image, Tel=args.telescope,
-                              quiet=not(args.verbose))
+    cframes = None
+    for i, image in enumerate(imgnames):
+        idata, header = loadFrame(image)
         if not(subimage is None):
             idata = idata - subimage
-        if cframes.ndim < 2:
-            cframes = idata.copy()
-        else:
-            cframes = np.dstack((cframes, idata))
+        if keep and cframes is None:
+            # allocate the stack once we know the frame size
+            shape = (len(imgnames),) + idata.shape
+            dtype = np.result_type(idata.dtype, np.float32)
+            if scratch:
+                cframes = np.memmap(tempfile.TemporaryFile(dir=scratch),
+                                    dtype=dtype, mode='w+', shape=shape)
+            else:
+                cframes = np.empty(shape, dtype=dtype)
+        if keep:
+            cframes[i] = idata
+        exptime.append(header.get('EXPTIME', 1.))
         stddev.append(np.std(idata))
-
         mean.append(np.mean(idata))
         median.append(np.median(idata))
         if args.verbose:
-            sys.stderr.write('\nMean: ' + str(np.mean(idata)) +
-                             '\tMedian: ' + str(np.median(idata)) +
-                             '\tstddev: '+str(np.std(idata)))
+            sys.stderr.write('\nMean: ' + str(mean[-1]) +
+                             '\tMedian: ' + str(median[-1]) +
+                             '\tstddev: '+str(stddev[-1]))
             sys.stderr.write('.\n')
 
+    return cframes, mean, median, stddev, exptime
+
+
+def combineBands(imgnames, band, subimage=None, **kwargs):
+    """
+    Combine a list of images band rows at a time, reading each band straight
+    from the (memory-mapped) files, so only one band of every frame is held
+    in memory. Bands are rows of each amplifier as stored in the files, so
+    they are read contiguously whether or not Telload() transposes the
+    instrument. Other keyword arguments are passed on to combineBand().
+
+    Returns the combined frame, arranged as by Telload().
+    """
+    frames = [mysci.TelAmps(image, Tel=args.telescope) for image in imgnames]
+    try:
+        plan = frames[0].plan
+        transpose = frames[0].instrument.transpose
+        mframe = np.empty(plan['shape'], dtype=np.float64)
+        for amp in range(len(frames[0])):
+            levels = [None] * len(frames)
+            if args.overscan:
+                levels = [amps.overscanlevel(amp) for amps in frames]
+            block = mframe[plan['place'][amp]]
+            if not(subimage is None):
+                subblock = subimage[plan['place'][amp]]
+            nrows = frames[0].raw(amp, native=True).shape[0]
+            for start in range(0, nrows, band):
+                stop = min(start + band, nrows)
+                # the same rows of the amplifier as arranged by Telload()
+                rows = slice(start, stop)
+                if transpose:
+                    rows = (slice(None), rows)
+                stack = None
+                for i, amps in enumerate(frames):
+                    idata = amps.rows(amp, start, stop)
+                    if args.overscan:
+                        # as in loadFrame()
+                        if not(np.issubdtype(idata.dtype, np.floating)) or \
+                                not(idata.flags.writeable):
+                            idata = idata.astype(np.float32)
+                        if not(levels[i] is None):
+                            idata -= levels[i][rows]
+                    if not(subimage is None):
+                        idata = idata - subblock[rows]
+                    if stack is None:
+                        stack = np.empty((len(frames),) + idata.shape,
+                                         dtype=np.result_type(idata.dtype,
+                                                              np.float32))
+                    stack[i] = idata
+                block[rows] = combineBand(
+                    stack.reshape((len(frames), -1)),
+                    **kwargs).reshape(stack.shape[1:])
+    finally:
+        for amps in frames:
+            amps.close()
+    return mframe
+
+
+def imageCombine(imgnames, frametype, sigma=3, subimage=None, normed=False,
+                 verbose=False, band=None, scratch=None, method='global',
+                 key=None):
+    """
+    Take a list of images, perform a specified combination operation and
+    return the final image. Optionally provide diagnostic feedback.
+
+    Arguments:
+      imgnames: ist or tuple of images to combine
+      frametype: type of image, for the file name and output
+      sigma: what sigma to use for sigma-clipping (default: 3)
+      subimage: image to subtract from all frames before processing
+      normed: normalize output file to 1? (default: False)
+      verbse: extra diagnostic output
+      band: combine this many rows at a time, read straight from the files
+            (see combineBands()) instead of loading the whole stack
+            (default: all at once)
+      scratch: directory for a memory-mapped frame stack, without band
+               (default: in memory)
+      method: combination method, see combineBand() (default: 'global',
+              mean clipped against the whole-stack mean and stddev)
+      key: calibration key (see calibKey()) to record in the header
+    """
+
+    # with band, frames are only loaded (one at a time) for their statistics
+    cframes, mean, median, stddev, exptime = loadStack(imgnames,
+                                                       subimage=subimage,
+                                                       scratch=scratch,
+                                                       keep=not(band))
+    # header information is taken from the last frame
+    image = imgnames[-1]
+
     sys.stderr.write('\n')
     sys.stderr.write('Loaded ' + str(len(mean)) + ' ' + frametype + ' frames.\n')
     if verbose:
@@ -66,15 +275,24 @@ def imageCombine(imgnames, frametype, sigma=3, subimage=None, normed=False,
         plt.legend()
         plt.show()
     # right now take all the frames, need to add selective frame-ignoring
-    totmean = np.mean(cframes)
-    totstddev = np.std(cframes)
-    cframes = np.ma.masked_where((cframes - totmean) > (sigma * totstddev), cframes)
-    mframe = np.mean(cframes, axis=2)
-    mframe = np.array(mframe.tolist())
+    # all frames are the same size, so the stack statistics follow from the
+    # per-frame ones
+    totmean = np.mean(mean)
+    totstddev = np.sqrt(np.mean(np.array(stddev)**2 + np.array(mean)**2) -
+                        totmean**2)
+    if band:
+        mframe = combineBands(imgnames, band, subimage=subimage,
+                              method=method, sigma=sigma, weights=exptime,
+                              center=totmean, spread=totstddev)
+    else:
+        nframes = cframes.shape[0]
+        mframe = combineBand(cframes.reshape((nframes, -1)), method=method,
+                             sigma=sigma, weights=exptime, center=totmean,
+                             spread=totstddev).reshape(cframes.shape[1:])
     if normed:
         mframe = mframe / np.mean(mframe)
     if args.verbose:
-        sys.stderr.write(str(cframes.shape) + '\n')
+        sys.stderr.write(str((len(imgnames),) + mframe.shape) + '\n')
         sys.stderr.write(str(mframe.shape) + '\n')
 
     datenow = datetime.datetime.today().isoformat()
@@ -83,12 +301,11 @@ def imageCombine(imgnames, frametype, sigma=3, subimage=None, normed=False,
     fname = 'master' + frametype + '.fits'
     if os.path.isfile(fname):
         sys.stderr.write('Deleting existing ' + fname + '\n')
-        input('PRESS ENTER TO CONTINUE')
         os.remove(fname)
     if len(mframe.shape) < 3:
         # copy header from an existing frame, add comments saying which
         # frames were combined and how they were combined.
-        frame = pyfits.PrimaryHDU(np.transpose(mframe))
+        frame = pyfits.PrimaryHDU(fileOrder(mframe))
         sframe = pyfits.open(image)
         # copy over the keywords we want
         for kw in kprop:
@@ -96,50 +313,40 @@ def imageCombine(imgnames, frametype, sigma=3, subimage=None, normed=False,
                 frame.header.set(kw, sframe[0].header[kw])
         # add reduction info to header
         frame.header['IMAGETYP'] = fname.split('.fits')[0]
+        if key:
+            frame.header['CALKEY'] = (key, 'hash of inputs/params')
         frame.header.add_history(datenow + ' - master ' + frametype + ' created')
-        frame.header.add_comment('Master ' + frametype + ' created from mean of: ' +
-                                 str(imgnames))
+        frame.header.add_comment('Master ' + frametype + ' created from ' +
+                                 method + ' combination of: ' + str(imgnames))
         frame.writeto(fname)
     else:
-        # we need to insert this new data into a copy of the old fits file
-        shutil.copy(image, fname)
-        frame = pyfits.open(fname, mode='update')
+        # write the data with the headers of the old fits file
+        sframe = pyfits.open(image)
+        frame = [pyfits.PrimaryHDU(header=sframe[0].header.copy())]
         frame[0].header['IMAGETYP'] = fname.split('.fits')[0]
+        if key:
+            frame[0].header['CALKEY'] = (key, 'hash of inputs/params')
         frame[0].header.add_history(datenow + ' - master ' + frametype + ' created')
-        frame[0].header.add_comment('Master ' + frametype + ' created from mean of: ' +
+        frame[0].header.add_comment('Master ' + frametype + ' created from ' +
+                                    method + ' combination of: ' +
                                     str(imgnames))
-        for hdu in range(1, len(frame)):
+        for hdu in range(1, len(sframe)):
             if verbose:
                 sys.stderr.write("Writing HDU " + str(hdu) + " with mean: " +
                                  str(np.mean(mframe[hdu-1])) + '\n')
-            frame[hdu].header['BZERO'] = 0.0    # don't rescale data
-            frame[hdu].data = np.transpose(mframe[hdu-1, :, :])
-        frame.close()
+            header = sframe[hdu].header.copy()
+            for kw in ['BZERO', 'BSCALE', 'BLANK', 'CHECKSUM', 'DATASUM']:
+                header.remove(kw, ignore_missing=True)   # don't rescale data
+            frame.append(pyfits.ImageHDU(fileOrder(mframe[hdu-1, :, :]),
+                                         header=header))
+        pyfits.HDUList(frame).writeto(fname)
+        sframe.close()
+    if key:
+        cacheProduct(fname, key)
 
     sys.stderr.write('\n')
-    del cframes 
-
+    del cframes
 
-parser = argparse.ArgumentParser(description='Pipeline to generate master \
-bias and flat frames, then apply those master calibration files to a batch \
-of science observations.')
-parser.add_argument('files', nargs='*', help='files to process')
-parser.add_argument('-t', '--telescope', action='store', default='none',
-                    help='Specify telescope type',
-                    choices=['VATT', '90Prime', 'Swope'])
-parser.add_argument('-p', '--plot', action='store_true',
-                    help='Plot diagnostics to the screen and pause before \
-continuing?')
-parser.add_argument('--masterbias', action='store',
-                    help='Use this master bias file instead of generating a \
-new one')
-parser.add_argument('--masterflat', action='store',
-                    help='Use this master flat file instead of generating a \
-new one')
-parser.add_argument('-v', '--verbose', action='store_true', default=False,
-                    help='Provide additional output. Mostly useful for \
-debugging.')
-args = parser.parse_args()
 
 # keywords to move from original files to the derived calibration files
 kprop = ['DETSIZE', 'CCDSUM', 'TIMESYS', 'OBJECT', 'DATE-OBS', 'DARKTIME',
@@ -147,163 +354,705 @@ kprop = ['DETSIZE', 'CCDSUM', 'TIMESYS', 'OBJECT', 'DATE-OBS', 'DARKTIME',
          'JULIAN', 'OBSERVAT', 'EPOCH', 'CAMTEMP', 'UT', 'TIME-OBS', 'ST',
          'EXPTIME']
 
-darks = []    # list of dark frames
-bias = []        # list of bias frames
-filters = []    # list of filters used
-flats = []    # flat frames (will be a 2D array, file ID and filter ID)
-objects = []    # object frames (2D array, as above)
-
-if args.telescope == 'Swope':
-    IMGKEY = 'EXPTYPE'
-else:
-    IMGKEY = 'IMAGETYP'
-
-# sort files by type
-for file1 in args.files:
-    file1 = glob.glob(file1)
-    for cfile in file1:
-        if os.path.isfile(cfile):
-            frame = pyfits.open(cfile)
-            thisfil = 0
-            if re.match('zero', frame[0].header[IMGKEY], re.IGNORECASE) or \
-               re.match('bias', frame[0].header[IMGKEY], re.IGNORECASE):
-                bias.append(cfile)
-            elif re.match('dark', frame[0].header[IMGKEY], re.IGNORECASE):
-                darks.append(cfile)
-            elif re.match('object', frame[0].header[IMGKEY], re.IGNORECASE):
-                thisfil = frame[0].header["FILTER"]
-                if not(thisfil in filters):
-                    filters.append(thisfil)
-                objects.append((cfile, thisfil))
-            elif re.match('flat', frame[0].header[IMGKEY], re.IGNORECASE):
-                thisfil = frame[0].header["FILTER"]
-                if not(thisfil in filters):
-                    filters.append(thisfil)
-                flats.append((cfile, thisfil))
+# master calibration frames loaded by this process
+_calcache = {}
+
+# rows of dark frames to combine at a time, unless --band is given
+DARKBAND = 256
+
+
+def loadFrame(image):
+    """
+    Load a frame as Telload() does, subtracting the overscan level of each
+    row if requested (--overscan) and the instrument has overscan sections.
+    Returns the frame and its primary header.
+    """
+    with mysci.TelAmps(image, Tel=args.telescope) as amps:
+        idata = amps.mosaic()
+        header = amps.frame[0].header
+        if not(args.overscan):
+            return idata, header
+        if not(np.issubdtype(idata.dtype, np.floating)) or \
+                not(idata.flags.writeable):
+            idata = idata.astype(np.float32)
+        for amp in range(len(amps)):
+            level = amps.overscanlevel(amp)
+            if level is not None:
+                idata[amps.plan['place'][amp]] -= level
+    return idata, header
+
+
+def fileOrder(idata):
+    """
+    Return an image arranged as by Telload() in the (y, x) order it is
+    written to files in: transposed back for instruments Telload()
+    transposes.
+    """
+    if mysci.getInstrument(args.telescope).transpose:
+        return np.transpose(idata)
+    return idata
+
+
+def loadCalib(fname):
+    """
+    Load a master calibration frame, keeping it for the life of the process.
+    """
+    if not(fname in _calcache):
+        instrument = mysci.getInstrument(args.telescope)
+        if instrument.layout == 'stack':
+            _calcache[fname] = mysci.Telload(fname, Tel=args.telescope,
+                                             quiet=not(args.verbose))
+        else:
+            # masters of instruments mosaicked into one image are written
+            # as a single image, see fileOrder()
+            _calcache[fname] = mysci.fitsopen(
+                fname, quiet=not(args.verbose),
+                native=not(instrument.transpose))
+    return _calcache[fname]
+
+
+def makeFlat(filtername, imgnames, biasname, key=None):
+    """
+    Create the master flat for one filter.
+    """
+    sys.stderr.write("Making master flat field for filter: " + filtername +
+                     ' ')
+    imageCombine(imgnames, "flat_"+filtername, normed=True,
+                 subimage=loadCalib(biasname), verbose=args.verbose,
+                 band=args.band, scratch=args.scratch, method=args.combine,
+                 key=key)
+
+
+def makeDark(label, imgnames, biasname, key=None):
+    """
+    Create the master dark for one group of dark frames.
+
+    Darks can be numerous, so they are always combined a band of rows at a
+    time, read straight from the files.
+    """
+    sys.stderr.write("Making master dark: " + label + ' ')
+    imageCombine(imgnames, "dark_"+label, subimage=loadCalib(biasname),
+                 verbose=args.verbose, band=args.band or DARKBAND,
+                 method=args.combine, key=key)
+
+
+def darkTime(header):
+    """
+    Return the dark current integration time of a frame: DARKTIME, or
+    EXPTIME if there is none.
+    """
+    dtime = header.get('DARKTIME')
+    if dtime is None:
+        dtime = header.get('EXPTIME')
+    return dtime
+
+
+def darkGroups(darks):
+    """
+    Group dark frames by dark time and CCDSUM (binning).
+
+    darks is a list of (file, header keywords). Returns a dictionary of
+    label: (dark time, CCDSUM, files), with labels like '300s_2x2'.
+    """
+    groups = {}
+    for image, header in darks:
+        dtime = darkTime(header)
+        ccdsum = header.get('CCDSUM')
+        label = 'dark' if dtime is None else '{0:g}s'.format(float(dtime))
+        if ccdsum is not None:
+            label += '_' + 'x'.join(str(ccdsum).split())
+        groups.setdefault(label, (dtime, ccdsum, []))[2].append(image)
+    return groups
+
+
+def matchDark(header, groups):
+    """
+    Return the label of the dark group for a frame: the one with the same
+    CCDSUM and the closest dark time (the dark is scaled to the frame), or
+    None if there is none.
+    """
+    dtime = darkTime(header)
+    best = None
+    for label, (gtime, ccdsum, images) in groups.items():
+        if ccdsum != header.get('CCDSUM'):
+            continue
+        dist = 0.
+        if dtime is not None and gtime is not None:
+            dist = abs(float(gtime) - float(dtime))
+        if best is None or dist < best[0]:
+            best = (dist, label)
+    return None if best is None else best[1]
+
+
+def codeVersion():
+    """
+    Return a hash of the source of this script and of mysci, so products
+    made by other versions of the code are not reused.
+    """
+    digest = hashlib.sha1()
+    for source in [__file__, mysci.mysci.__file__]:
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def fileDigest(fname, checksum=False):
+    """
+    Return what identifies the contents of an input file for calibKey(): its
+    name, size and modification time, or with checksum=True, its name and
+    the SHA-1 of its contents.
+    """
+    if checksum:
+        digest = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return [os.path.abspath(fname), digest.hexdigest()]
+    stat = os.stat(fname)
+    return [os.path.abspath(fname), stat.st_size, stat.st_mtime_ns]
+
+
+def calibKey(imgnames, params, checksum=False):
+    """
+    Return a hash identifying a derived product: of the parameters (a
+    dictionary, including the keys of the products it depends on and the
+    code version) and the sorted list of input files, each identified by
+    fileDigest().
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for image in sorted(imgnames, key=os.path.abspath):
+        digest.update(json.dumps(fileDigest(image, checksum)).encode())
+    return digest.hexdigest()
+
+
+def cacheFile(key):
+    """
+    Return the calibration cache file for a key.
+    """
+    return os.path.join(args.cache, key + '.fits')
+
+
+def linkFile(src, dst):
+    """
+    Atomically make dst a hard link to (or, across file systems, a copy of)
+    src.
+    """
+    tmp = dst + '.' + str(os.getpid()) + '.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def cacheProduct(fname, key):
+    """
+    Store a newly written product in the calibration cache under its key.
+    """
+    if not(os.path.isdir(args.cache)):
+        os.makedirs(args.cache, exist_ok=True)
+    linkFile(fname, cacheFile(key))
+
+
+def cachedProduct(fname, key):
+    """
+    If the calibration cache has a product for key, put it in place as
+    fname and return True; otherwise return False.
+    """
+    cached = cacheFile(key)
+    if not(os.path.isfile(cached)):
+        return False
+    if not(os.path.isfile(fname) and os.path.samefile(cached, fname)):
+        linkFile(cached, fname)
+    return True
+
+
+def calibrate(idata, bias, flat, level=None, dark=None, darkscale=1.,
+              block=65536):
+    """
+    Calibrate idata in place: subtract the overscan level, the bias and the
+    dark scaled by darkscale, then divide by the flat.
+
+    All steps are applied to blocks of about block pixels at a time, so each
+    block stays in cache between steps and idata is only read and written
+    once, without full-frame temporaries.
+    """
+    rows = max(1, block // max(1, idata[0].size))
+    if level is not None:
+        level = np.broadcast_to(level, idata.shape)
+    if dark is not None:
+        tmp = np.empty((rows,) + idata.shape[1:], dtype=idata.dtype)
+    for start in range(0, len(idata), rows):
+        sl = slice(start, start + rows)
+        chunk = idata[sl]
+        if level is not None:
+            chunk -= level[sl]
+        chunk -= bias[sl]
+        if dark is not None:
+            np.multiply(dark[sl], darkscale, out=tmp[:len(chunk)])
+            chunk -= tmp[:len(chunk)]
+        chunk /= flat[sl]
+    return idata
+
+
+def processObject(image, biasname, flatname, darkname=None, key=None):
+    """
+    Overscan, bias, dark and flat field correct a single object frame.
+
+    Each amplifier is calibrated in place in a single pass and the result is
+    written to a new file with the headers of the original. With a key, the
+    product is also stored in the calibration cache.
+    """
+    datenow = datetime.datetime.today().isoformat()
+    rootn = re.split('.fits', image)[0]
+    fname = rootn + '-bsub_flat.fits'
+    if os.path.isfile(fname):
+        sys.stderr.write('Deleting existing ' + fname+'\n')
+        os.remove(fname)
+    sys.stderr.write('\t' + image + '. Writing as ' + fname+'.\t')
+
+    bias = loadCalib(biasname)
+    flat = loadCalib(flatname)
+    dark = None
+    darkscale = 1.
+    instrument = mysci.getInstrument(args.telescope)
+    with mysci.TelAmps(image, Tel=args.telescope,
+                       dtype=np.result_type(bias, flat)) as amps:
+        if darkname is not None:
+            # scale the dark to the dark time of this frame
+            dark = loadCalib(darkname)
+            dtime = darkTime(amps.frame[0].header)
+            mtime = darkTime(pyfits.getheader(darkname))
+            if dtime is not None and mtime:
+                darkscale = float(dtime) / float(mtime)
+        # the scaled copy of the frame is the working buffer
+        idata = amps.mosaic()
+        if not(idata.flags.writeable):
+            idata = idata.copy()
+        for amp in range(len(amps)):
+            place = amps.plan['place'][amp]
+            level = None
+            if args.overscan:
+                level = amps.overscanlevel(amp)
+            calibrate(idata[place], bias[place], flat[place], level=level,
+                      dark=None if dark is None else dark[place],
+                      darkscale=darkscale)
+            if args.verbose:
+                sys.stderr.write("Calibrated amplifier " + str(amp) +
+                                 " with mean: " +
+                                 str(np.mean(idata[place])) + '\t')
+                sys.stderr.write(str(idata[place].shape) + '\t')
+                sys.stderr.write(str(idata.dtype) + '\n')
+
+        steps = 'Bias and flat field corrected'
+        if args.overscan:
+            steps = 'Overscan, bias and flat field corrected'
+        if dark is not None:
+            steps = steps.replace(' and flat', ', dark (scaled by ' +
+                                  str(darkscale) + ') and flat')
+        # the calibrated data is written as floats, so drop the scaling
+        # keywords (and checksums) of the original headers
+        drop = ['BZERO', 'BSCALE', 'BLANK', 'CHECKSUM', 'DATASUM']
+        primary = amps.frame[0].header.copy()
+        primary.add_history(datenow + ' - ' + steps)
+        if instrument.layout == 'stack':
+            hdus = [pyfits.PrimaryHDU(header=primary)]
+            for amp in range(len(amps)):
+                header = amps.header(amp).copy()
+                for kw in drop:
+                    header.remove(kw, ignore_missing=True)
+                hdus.append(pyfits.ImageHDU(fileOrder(idata[amp]),
+                                            header=header))
+        else:
+            # one image, like the master calibrations
+            for kw in drop:
+                primary.remove(kw, ignore_missing=True)
+            hdus = [pyfits.PrimaryHDU(fileOrder(idata), header=primary)]
+        pyfits.HDUList(hdus).writeto(fname)
+    if key:
+        cacheProduct(fname, key)
+    sys.stderr.write('Success.\n')
+
+
+def initWorker(wargs):
+    """
+    Set up the command line arguments in a worker process.
+    """
+    global args
+    args = wargs
+
+
+def timedCall(func, fargs):
+    """
+    Run func(*fargs), returning the start and end times.
+    """
+    start = time.time()
+    func(*fargs)
+    return start, time.time()
+
+
+def runTasks(tasks, workers=1):
+    """
+    Run a dependency graph of tasks.
+
+    tasks is an (ordered) dictionary of name: (stage, function, arguments,
+    dependencies). A task is started as soon as all of its dependencies have
+    finished; with workers > 1, independent tasks run concurrently in a pool
+    of processes.
+
+    Returns a dictionary of stage: list of (start, end) times.
+    """
+    timing = {}
+    done = set()
+    pending = dict(tasks)
+    running = {}
+    pool = None
+    if workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(workers,
+                                                      initializer=initWorker,
+                                                      initargs=(args,))
+    while pending or running:
+        ready = [name for name in pending if set(pending[name][3]) <= done]
+        if not(ready) and not(running):
+            sys.stderr.write('ERROR: unresolvable task dependencies: ' +
+                             str(list(pending)) + '\n')
+            break
+        for name in ready:
+            stage, func, fargs, deps = pending.pop(name)
+            if pool is None:
+                timing.setdefault(stage, []).append(timedCall(func, fargs))
+                done.add(name)
             else:
-                sys.stderr.write(cfile+' - unknown image type ("' + 
-                                 frame[0].header[IMGKEY] + '"), ignoring.\n')
-            frame.close()
-
-sys.stderr.write(str(len(args.files)) + ' files inspected.\n')
-sys.stderr.write(str(len(darks)) + ' dark frames found. ')
-sys.stderr.write(str(len(bias)) + ' bias frames found. ')
-sys.stderr.write(str(len(flats)) + ' flat frames found.\n')
-sys.stderr.write(str(len(objects)) + ' object frames with ' +
-                 str(len(filters)) + ' filters identified (')
-for i in filters:
-    sys.stderr.write(i + ' ')
-sys.stderr.write(')\n\n')
-
-if args.masterbias:
-    if not(os.path.isfile(args.masterbias)):
-        sys.stderr.write('ERROR: specified master bias file does not exist. \
+                running[pool.submit(timedCall, func, fargs)] = (name, stage)
+        if running:
+            finished, unused = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name, stage = running.pop(future)
+                timing.setdefault(stage, []).append(future.result())
+                done.add(name)
+    if pool is not None:
+        pool.shutdown()
+
+    return timing
+
+
+def listFiles(patterns, settle=0):
+    """
+    Return the raw frames matching a list of file names or glob patterns,
+    leaving out derived products (master calibrations and calibrated
+    frames) and files modified less than settle seconds ago, which may still
+    be being written.
+    """
+    files = []
+    now = time.time()
+    for pattern in patterns:
+        for fname in sorted(glob.glob(pattern)):
+            base = os.path.basename(fname)
+            if not(os.path.isfile(fname)) or base.startswith('master') or \
+                    base.endswith('-bsub_flat.fits') or fname in files:
+                continue
+            try:
+                if settle and now - os.path.getmtime(fname) < settle:
+                    continue
+            except FileNotFoundError:
+                # removed or renamed since the glob
+                continue
+            files.append(fname)
+    return files
+
+
+def fileStates(files):
+    """
+    Return the (name, size, modification time) of each file, statting each
+    once. Files removed or renamed since they were listed are left out.
+    """
+    states = []
+    for fname in files:
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        states.append((fname, stat.st_size, stat.st_mtime_ns))
+    return states
+
+
+def reduceNight(files):
+    """
+    Reduce a night of data: make (or reuse) the master calibrations and
+    calibrate the object frames that are new or whose calibrations changed.
+    """
+    darks = []    # list of dark frames
+    bias = []        # list of bias frames
+    filters = []    # list of filters used
+    flats = []    # flat frames (will be a 2D array, file ID and filter ID)
+    objects = []    # object frames (2D array, as above)
+
+    # header keywords for the image type and filter of this instrument
+    instrument = mysci.getInstrument(args.telescope)
+    IMGKEY = instrument.imgkey
+    FILTKEY = instrument.filterkeys[0]
+
+    # sort files by type, using the cached primary header keywords
+    keywords = instrument.keywords + [kw for kw in
+                                      ['EXPTIME', 'DARKTIME', 'CCDSUM']
+                                      if kw not in instrument.keywords]
+    with mysci.HeaderIndex(args.index, threads=args.threads) as index:
+        headers = index.refresh(files, keywords=keywords)
+    for cfile, header in headers:
+        if header is None:
+            sys.stderr.write(cfile + ' - could not read header, ignoring.\n')
+            continue
+        imgtype = str(header[IMGKEY])
+        thisfil = 0
+        if re.match('zero', imgtype, re.IGNORECASE) or \
+           re.match('bias', imgtype, re.IGNORECASE):
+            bias.append(cfile)
+        elif re.match('dark', imgtype, re.IGNORECASE):
+            darks.append((cfile, header))
+        elif re.match('object', imgtype, re.IGNORECASE):
+            thisfil = header[FILTKEY]
+            if not(thisfil in filters):
+                filters.append(thisfil)
+            objects.append((cfile, thisfil, header))
+        elif re.match('flat', imgtype, re.IGNORECASE):
+            thisfil = header[FILTKEY]
+            if not(thisfil in filters):
+                filters.append(thisfil)
+            flats.append((cfile, thisfil))
+        else:
+            sys.stderr.write(cfile+' - unknown image type ("' + imgtype +
+                             '"), ignoring.\n')
+
+    sys.stderr.write(str(len(files)) + ' files inspected.\n')
+    sys.stderr.write(str(len(darks)) + ' dark frames found. ')
+    sys.stderr.write(str(len(bias)) + ' bias frames found. ')
+    sys.stderr.write(str(len(flats)) + ' flat frames found.\n')
+    sys.stderr.write(str(len(objects)) + ' object frames with ' +
+                     str(len(filters)) + ' filters identified (')
+    for i in filters:
+        sys.stderr.write(i + ' ')
+    sys.stderr.write(')\n\n')
+
+    tasks = {}
+    products = []
+    # derived products are kept in the calibration cache, keyed by a hash of
+    # their inputs, parameters and the code version, and reused if unchanged
+    params = {'telescope': args.telescope, 'overscan': args.overscan,
+              'combine': args.combine, 'sigma': 3, 'code': codeVersion()}
+    manifest = {}
+
+    def schedule(name, stage, inputs, pars, task):
+        """
+        Reuse the product name from the cache, or schedule its task. Returns
+        the product's key and the names of the tasks it needs.
+        """
+        key = calibKey(inputs, pars, checksum=args.checksum)
+        manifest[name] = {'key': key, 'stage': stage,
+                          'inputs': sorted(os.path.abspath(image)
+                                           for image in inputs),
+                          'params': pars}
+        if cachedProduct(name, key):
+            if args.verbose:
+                sys.stderr.write('Using cached ' + name + '\n')
+            manifest[name]['status'] = 'cached'
+            return key, []
+        taskname, func, fargs, deps = task(key)
+        tasks[taskname] = (stage, func, fargs, deps)
+        products.append(name)
+        manifest[name]['status'] = 'built'
+        return key, [taskname]
+
+    if args.masterbias:
+        if not(os.path.isfile(args.masterbias)):
+            sys.stderr.write('ERROR: specified master bias file does not exist. \
 Exiting.\n\n')
-        sys.exit(-1)
-    else:
-        sys.stderr.write('Using user-specified master bias: ' +
-                         args.masterbias+'\n\n')
-        mbias = mysci.Telload(args.masterbias, Tel=args.telescope,
-                              quiet=not(args.verbose))
-else:   # make a master bias and load it
-    imageCombine(bias, 'bias', verbose=args.verbose)
-    mbias = mysci.Telload('masterbias.fits', Tel=args.telescope,
-                          quiet=not(args.verbose))
-
-sys.stderr.write('\n\n\nNOTE: We are ignoring dark frames at the \
-moment!!!!!\n\n\n')
-
-# See if there are any dark frames, make a master dark.
-"""
-if len(darks) > 0:
-    # we have darks!
-    mean = []
-    median = []
-    stddev = []
-    dframes = np.array([0])
-    sys.stderr.write('Creating a master dark frame\n')
-    sys.stderr.write('Loading dark frames')
-    for image in darks:
-        if bframes.ndim < 2:
-            bframes.resize(idata.shape)
-            bframes = idata-mbias
+            sys.exit(-1)
         else:
-            # bias subtraction included
-            bframes = np.dstack((bframes,idata-mbias))
+            sys.stderr.write('Using user-specified master bias: ' +
+                             args.masterbias+'\n\n')
+            biasname = args.masterbias
+            biasdeps = []
+            biaskey = calibKey([biasname], {}, checksum=args.checksum)
+    else:   # make a master bias
+        biasname = 'masterbias.fits'
+        bias = sorted(bias)
+        biaskey, biasdeps = schedule(
+            biasname, 'bias', bias, dict(params, type='bias'),
+            lambda key: ('bias', imageCombine,
+                         (bias, 'bias', 3, None, False, args.verbose,
+                          args.band, args.scratch, args.combine, key), []))
 
-        # get the exposure time for the dark frame, add it to a list
-        # use this to make sure we're only combining appropriate dark frames
-        # (not yet implemented)
+    # make a master dark for each dark time and binning, each science frame
+    # uses the closest one, scaled to its dark time
+    groups = darkGroups(darks)
+    darkkeys = {}
+    darkdeps = {}
+    for label in sorted(groups):
+        images = sorted(groups[label][2])
+        darkkeys[label], deps = schedule(
+            'masterdark_' + label + '.fits', 'dark', images,
+            dict(params, type='dark', bias=biaskey),
+            lambda key: ('dark_'+label, makeDark,
+                         (label, images, biasname, key), biasdeps))
+        darkdeps[label] = biasdeps + deps
+    if len(darks) == 0:
+        sys.stderr.write('No dark frames found.. not creating a master dark.\n')
 
+    # Create a master flat for each filter, then process the object frames for
+    # that filter as soon as it is available
+    for filtername in filters:
+        thisfiltfiles = []
+        for image in flats:
+            if re.match(filtername, image[1]):
+                thisfiltfiles.append(image[0])
+        if len(thisfiltfiles) == 0:
+            sys.stderr.write('No flat frames for filter ' + filtername +
+                             ', skipping its object frames.\n')
+            continue
+        thisfiltfiles.sort()
+        flatname = 'masterflat_' + filtername + '.fits'
+        flatkey, deps = schedule(
+            flatname, 'flat', thisfiltfiles,
+            dict(params, type='flat', bias=biaskey),
+            lambda key: ('flat_'+filtername, makeFlat,
+                         (filtername, thisfiltfiles, biasname, key),
+                         biasdeps))
+        flatdeps = biasdeps + deps
+        for image in objects:
+            if re.match(filtername, image[1]):
+                label = matchDark(image[2], groups)
+                darkname = None
+                deps = flatdeps
+                if label is not None:
+                    darkname = 'masterdark_' + label + '.fits'
+                    deps = flatdeps + [dep for dep in darkdeps[label]
+                                       if dep not in flatdeps]
+                schedule(re.split('.fits', image[0])[0] + '-bsub_flat.fits',
+                         'object', [image[0]],
+                         dict(params, type='object', bias=biaskey,
+                              flat=flatkey, dark=darkkeys.get(label)),
+                         lambda key: ('object_'+image[0], processObject,
+                                      (image[0], biasname, flatname,
+                                       darkname, key), deps))
 
-        stddev.append(np.std(idata))
-        mean.append(np.mean(idata))
-        median.append(np.median(idata))
-        sys.stderr.write('.')
+    # remove outdated products up front
+    existing = [fname for fname in products if os.path.isfile(fname)]
+    if existing:
+        sys.stderr.write('Deleting outdated ' + ', '.join(existing) + '\n')
+        for fname in existing:
+            os.remove(fname)
+    sys.stderr.write(str(len(manifest) - len(products)) + ' products reused \
+from the cache, ' + str(len(products)) + ' to make.\n')
 
-    sys.stderr.write('\n')
-    sys.stderr.write('Loaded ' + str(len(mean)) + ' dark frames.\n')
+    sys.stderr.write('Creating master calibrations and processing object \
+frames (bias, dark and flat correction).\n')
+    timing = runTasks(tasks, workers=args.workers)
 
+    # record what each product was made from
+    manifestname = os.path.join(args.cache, 'manifest.json')
+    if os.path.isfile(manifestname):
+        with open(manifestname) as f:
+            manifest = dict(json.load(f), **manifest)
+    if not(os.path.isdir(args.cache)):
+        os.makedirs(args.cache, exist_ok=True)
+    with open(manifestname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write('\n')
+    os.replace(manifestname + '.tmp', manifestname)
 
+    # timing report
+    sys.stderr.write('\nStage timing:\n')
+    for stage in ['bias', 'dark', 'flat', 'object']:
+        if stage in timing:
+            times = np.array(timing[stage])
+            total = np.sum(times[:, 1] - times[:, 0])
+            span = times[:, 1].max() - times[:, 0].min()
+            sys.stderr.write('\t' + stage + ': ' + str(len(times)) +
+                             ' task(s), ' + '{0:.2f}'.format(total) +
+                             ' s total, ' + '{0:.2f}'.format(span) +
+                             ' s elapsed\n')
 
-else:
-    sys.stderr.write('No dark frames found.. not creating a master dark.\n\n')
-"""
+    sys.stderr.write('Finished processing ' + str(len(filters)) +
+                     ' filters.\n\n')
 
-mflats = np.array([0])
-# Create a master flat
-# first load all the flat files (and normalize them), then loop over filters
-sys.stderr.write('Creating master flats.\n')
-for filtername in filters:
-    sys.stderr.write("Making master flat field for filter: " + filtername + ' ')
-    fframes = np.array([0])
-    stddev = []
-    thisfiltfiles = []
-    for image in flats:
-        if re.match(filtername, image[1]):
-            thisfiltfiles.append(image[0])
-    imageCombine(thisfiltfiles, "flat_"+filtername, normed=True,
-                 subimage=mbias, verbose=args.verbose)
-
-# now process the individual object frames, going by filter
-sys.stderr.write('\n\nProcessing object frames (bias and flat correction)\n')
-i = 0
-for filter in filters:
-    sys.stderr.write('Filter: ' + filter+'.\n')
-    # locate the flat we want to use
-    flatnum = filters.index(filter)
-    for image in objects:
-        if re.match(filter, image[1]):
-            # filter for object matches what we're trying
-            idata = mysci.Telload(image[0], Tel=args.telescope,
-                                  quiet=not(args.verbose))
-            datenow = datetime.datetime.today().isoformat()
-
-            idata = idata-mbias
-
-            idata = idata/mflats[flatnum]
-            rootn = re.split('.fits', image[0])[0]
-            fname = rootn + '-bsub_flat.fits'
-            if os.path.isfile(fname):
-                sys.stderr.write('Deleting existing ' + fname+'\n')
-                input('PRESS ENTER TO CONTINUE')
-                os.remove(fname)
-            sys.stderr.write('\t' + image[0] + '. Writing as ' + fname+'.\t')
-            shutil.copy(image[0], fname)
-            frame = pyfits.open(fname, mode='update')
-            frame[0].header.add_history(datenow +
-                                        ' - Bias and flat field corrected')
-            for hdu in range(1, len(frame)):
-                if args.verbose:
-                    sys.stderr.write("Writing HDU " + str(hdu) +
-                                     " with mean: " +
-                                     str(np.mean(data[hdu-1])) + '\t')
-                    sys.stderr.write(str(idata[hdu-1, :, :].shape) + '\t')
-                    sys.stderr.write(str(idata[hdu-1, :, :].dtype) + '\n')
-                frame[hdu].header['BZERO'] = 0.0    # don't rescale data
-                frame[hdu].data = np.transpose(idata[hdu-1, :, :])
-            frame.close()
-            sys.stderr.write('Success.\n')
-    i = i+1
-
-sys.stderr.write('Finished processing ' + str(i) + ' filters.\n\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pipeline to generate master \
+bias and flat frames, then apply those master calibration files to a batch \
+of science observations.')
+    parser.add_argument('files', nargs='*', help='files to process')
+    parser.add_argument('-t', '--telescope', action='store', default='none',
+                        help='Specify telescope type',
+                        choices=sorted(name for name, instrument in
+                                       mysci.instruments.items()
+                                       if instrument.imaging))
+    parser.add_argument('-p', '--plot', action='store_true',
+                        help='Plot diagnostics to the screen and pause before \
+continuing?')
+    parser.add_argument('--masterbias', action='store',
+                        help='Use this master bias file instead of generating a \
+new one')
+    parser.add_argument('--masterflat', action='store',
+                        help='Use this master flat file instead of generating a \
+new one')
+    parser.add_argument('--band', action='store', type=int, default=None,
+                        help='Combine calibration frames this many rows at a \
+time, reading each band from the files, instead of loading whole frames \
+(default: whole frames).')
+    parser.add_argument('--scratch', action='store', default=None,
+                        help='Keep calibration frame stacks (without --band) \
+in a memory-mapped file in this directory instead of in memory.')
+    parser.add_argument('--combine', action='store', default='global',
+                        choices=['global', 'sigclip', 'median', 'minmax', 'wmean'],
+                        help='Method for combining calibration frames (default: \
+global, mean clipped against the whole-stack mean and stddev).')
+    parser.add_argument('--overscan', action='store_true', default=False,
+                        help='Subtract the median overscan level of each row \
+(for instruments with overscan sections) before the bias.')
+    parser.add_argument('--cache', action='store', default='.calcache',
+                        help='Directory to keep derived products in, keyed by \
+a hash of their inputs, parameters and the code version, so unchanged ones are \
+reused (default: .calcache).')
+    parser.add_argument('--checksum', action='store_true', default=False,
+                        help='Identify input files by a checksum of their \
+contents rather than their size and modification time.')
+    parser.add_argument('--watch', action='store', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Keep running, checking for new or changed \
+frames every SECONDS and reducing only what they affect.')
+    parser.add_argument('--settle', action='store', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Ignore frames modified in the last SECONDS, \
+which may still be being written (default: 10 with --watch, else 0).')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=1,
+                        help='Number of processes to run independent steps \
+(master flats, object frames) with (default: 1).')
+    parser.add_argument('--index', action='store', default='.fitsindex.db',
+                        help='File to cache header keywords in, so they are \
+only re-read from changed files (default: .fitsindex.db).')
+    parser.add_argument('--threads', action='store', type=int, default=8,
+                        help='Number of file headers to read concurrently, \
+to hide network file system latency (default: 8).')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Provide additional output. Mostly useful for \
+debugging.')
+    args = parser.parse_args()
+
+    if args.watch:
+        settle = 10. if args.settle is None else args.settle
+        sys.stderr.write('Watching for new frames every ' +
+                         str(args.watch) + ' s, press Ctrl-C to stop.\n')
+        state = None
+        try:
+            while True:
+                # only reduce again if a frame was added or changed
+                current = fileStates(listFiles(args.files, settle=settle))
+                if current != state:
+                    reduceNight([fname for fname, size, mtime in current])
+                    state = current
+                time.sleep(args.watch)
+        except KeyboardInterrupt:
+            sys.stderr.write('Stopped watching.\n')
+    else:
+        reduceNight(listFiles(args.files, settle=args.settle or 0))
@@ -1,4 +1,6 @@
 # __init__.py
 
-from .vcosmic import vcosmic
+from .vcosmic import vcosmic, VelocityFlowModel
+from .fitsindex import readPrimaryHeader, readKeywords, \
+    readHeaders, parseQuery, HeaderIndex
 from .mysci import *
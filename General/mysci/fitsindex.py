@@ -0,0 +1,577 @@
+# fitsindex.py
+#
+# On-disk index of FITS primary header keywords, so that classifying and
+# selecting files does not require opening every file on every run.
+
+import os as _os
+import re as _re
+import gzip as _gzip
+import json as _json
+import sqlite3 as _sqlite3
+import concurrent.futures as _futures
+import numpy as _np
+from astropy.io import fits as _pyfits
+
+_BLOCK = 2880
+_CARD = 80
+
+# version of the cache layout, bump to force a rebuild of existing indices
+_SCHEMA = 1
+
+
+def _primaryBytes(fname):
+    """
+    Return the raw primary header of a FITS file, up to and including the
+    block with the END card. None of the data units are read.
+    """
+
+    if fname.endswith('.gz'):
+        f = _gzip.open(fname, 'rb')
+    else:
+        f = open(fname, 'rb')
+    with f:
+        blocks = []
+        while True:
+            block = f.read(_BLOCK)
+            if len(block) < _BLOCK:
+                raise IOError(fname + ': no END card in the primary header.')
+            blocks.append(block)
+            if any(block[i:i+8] == b'END     '
+                   for i in range(0, _BLOCK, _CARD)):
+                break
+
+    return b''.join(blocks).decode('ascii')
+
+
+def readPrimaryHeader(fname):
+    """
+    Read only the primary header of a FITS file, stopping at the END card.
+
+    Returns an astropy Header.
+    """
+
+    return _pyfits.Header.fromstring(_primaryBytes(fname))
+
+
+def _cardkey(kw):
+    """
+    Normalize a keyword, so 'HIERARCH ESO DPR TYPE' and 'ESO DPR TYPE' match.
+    """
+
+    kw = kw.upper().split()
+    if kw and kw[0] == 'HIERARCH':
+        kw = kw[1:]
+    return ' '.join(kw)
+
+
+def readKeywords(fname, keywords):
+    """
+    Read a few keywords from the primary header of a FITS file. Only the
+    cards for the requested keywords are parsed.
+
+    Returns a dictionary of keyword: value, with None for missing keywords.
+    """
+
+    wanted = dict((_cardkey(kw), kw) for kw in keywords)
+    values = dict((kw, None) for kw in keywords)
+    header = _primaryBytes(fname)
+    ncards = len(header) // _CARD
+    for i in range(ncards):
+        card = header[i*_CARD:(i+1)*_CARD]
+        if card.startswith('HIERARCH '):
+            key = _cardkey(card[9:].split('=', 1)[0])
+        else:
+            key = card[:8].rstrip()
+        if key in wanted:
+            # long strings continue on the following cards
+            end = i + 1
+            while end < ncards and header[end*_CARD:end*_CARD+8] == \
+                    'CONTINUE':
+                end += 1
+            val = _pyfits.Card.fromstring(header[i*_CARD:end*_CARD]).value
+            values[wanted[key]] = _value(val)
+        elif key == 'END':
+            break
+
+    return values
+
+
+def _threadmap(func, items, threads=8):
+    """
+    map() over a list with a pool of threads, overlapping the I/O latency of
+    the calls. Results are returned in the order of the items.
+    """
+
+    if threads <= 1 or len(items) <= 1:
+        return list(map(func, items))
+    # hand out the items in chunks, to keep the overhead small for quick
+    # calls (e.g. local files)
+    step = max(1, len(items) // (4 * threads))
+    chunks = [items[i:i+step] for i in range(0, len(items), step)]
+    with _futures.ThreadPoolExecutor(min(threads, len(chunks))) as pool:
+        return [result for chunk in
+                pool.map(lambda chunk: [func(item) for item in chunk], chunks)
+                for result in chunk]
+
+
+def readHeaders(files, keywords, threads=8):
+    """
+    Read keywords from the primary headers of many files (see
+    readKeywords()), with several files read concurrently.
+
+    Returns a list of keyword dictionaries in the order of files, with
+    None for files which cannot be read.
+    """
+
+    def read(fname):
+        try:
+            return readKeywords(fname, keywords)
+        except (IOError, ValueError, UnicodeDecodeError):
+            return None
+
+    return _threadmap(read, list(files), threads=threads)
+
+
+def _check(path, entry, keywords):
+    """
+    Check one file against its index entry, re-reading its header if the
+    file changed or keywords are missing from the entry.
+
+    Returns the keyword dictionary (None if the file cannot be read) and
+    the new index entry (None if the entry is up to date).
+    """
+
+    try:
+        stat = _os.stat(path)
+    except OSError:
+        return None, None
+    if entry is not None and entry[0] == stat.st_size and \
+       entry[1] == stat.st_mtime and all(kw in entry[2] for kw in keywords):
+        return entry[2], None
+    # keep recording the keywords asked for previously
+    kwlist = keywords
+    if entry is not None:
+        kwlist = list(entry[2]) + [kw for kw in keywords
+                                   if kw not in entry[2]]
+    try:
+        values = readKeywords(path, kwlist)
+    except (IOError, ValueError, UnicodeDecodeError):
+        return None, None
+    return values, (stat.st_size, stat.st_mtime, values)
+
+
+def _value(val):
+    """
+    Return a header value in a form that can be stored as JSON.
+    """
+
+    if isinstance(val, (bool, int, float, str)):
+        return val
+    if val is None or isinstance(val, _pyfits.card.Undefined):
+        return None
+    return str(val)
+
+
+# query language tokens: quoted strings, operators and bare words (keywords,
+# numbers, dates, ...)
+_TOKEN = _re.compile(r"""\s*(?:("[^"]*"|'[^']*')|(<=|>=|==|!=|=|<|>|~|\(|\)|,)|
+                         ([^\s()<>=!~,'"]+))""", _re.VERBOSE)
+_WORDS = ['and', 'or', 'not', 'in', 'between']
+
+
+def _tokenize(text):
+    """
+    Split a query into (type, value) tokens.
+    """
+
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('Cannot parse query at: ' + text[pos:])
+        pos = match.end()
+        string, op, word = match.groups()
+        if string is not None:
+            tokens.append(('value', string[1:-1]))
+        elif op is not None:
+            tokens.append(('op', op))
+        elif word.lower() in _WORDS:
+            tokens.append(('op', word.lower()))
+        else:
+            tokens.append(('value', word))
+    return tokens
+
+
+def parseQuery(text):
+    """
+    Parse a selection query into a tree of tuples.
+
+    Queries combine comparisons with 'and', 'or', 'not' and parentheses.
+    Comparisons are
+      KEY op VALUE            op is one of = (or ==), !=, <, <=, >, >=
+      KEY ~ REGEX             regular expression search on the value
+      KEY in (V1, V2, ...)    equal to any of the values
+      KEY between V1 and V2   V1 <= value <= V2
+    Values which look like numbers are compared numerically, everything
+    else (e.g. ISO dates) as strings. Values with spaces or special
+    characters can be quoted.
+
+    Example:
+      ITIME>=60 and FILTER in (J,H) and DATE-OBS between 2011-03-01 and
+      2011-06-30
+    """
+
+    tokens = _tokenize(text)
+    pos = [0]
+
+    def peek():
+        if pos[0] < len(tokens):
+            return tokens[pos[0]]
+        return (None, None)
+
+    def take(kind=None, value=None):
+        tok = peek()
+        if tok[0] is None or (kind and tok[0] != kind) or \
+           (value and tok[1] != value):
+            raise ValueError('Unexpected ' + str(tok[1]) + ' in query: ' +
+                             text)
+        pos[0] += 1
+        return tok[1]
+
+    def expr():
+        node = term()
+        while peek() == ('op', 'or'):
+            take()
+            node = ('or', node, term())
+        return node
+
+    def term():
+        node = factor()
+        while peek() == ('op', 'and'):
+            take()
+            node = ('and', node, factor())
+        return node
+
+    def factor():
+        if peek() == ('op', 'not'):
+            take()
+            return ('not', factor())
+        if peek() == ('op', '('):
+            take()
+            node = expr()
+            take('op', ')')
+            return node
+        key = take('value')
+        op = take('op')
+        if op == 'in':
+            take('op', '(')
+            values = [take('value')]
+            while peek() == ('op', ','):
+                take()
+                values.append(take('value'))
+            take('op', ')')
+            return ('in', key, values)
+        if op == 'between':
+            low = take('value')
+            take('op', 'and')
+            return ('between', key, low, take('value'))
+        if op == '==':
+            op = '='
+        if not(op in ['=', '!=', '<', '<=', '>', '>=', '~']):
+            raise ValueError('Unknown comparison ' + op + ' in query: ' +
+                             text)
+        return (op, key, take('value'))
+
+    node = expr()
+    if pos[0] != len(tokens):
+        raise ValueError('Unexpected ' + str(peek()[1]) + ' in query: ' +
+                         text)
+    return node
+
+
+def queryKeywords(node):
+    """
+    Return the header keywords a parsed query refers to.
+    """
+
+    if node[0] in ['and', 'or']:
+        return queryKeywords(node[1]) + [kw for kw in queryKeywords(node[2])
+                                         if kw not in queryKeywords(node[1])]
+    if node[0] == 'not':
+        return queryKeywords(node[1])
+    return [node[1]]
+
+
+def _number(val):
+    """
+    Convert a query value to a float, or None if it is not a number.
+    """
+
+    try:
+        return float(val)
+    except ValueError:
+        return None
+
+
+def _compare(op, column, val):
+    """
+    Order comparison of one (numeric or string) column against a value.
+    """
+
+    if op == '<':
+        return column < val
+    elif op == '<=':
+        return column <= val
+    elif op == '>':
+        return column > val
+    return column >= val
+
+
+def _evaluate(node, columns, aliases):
+    """
+    Evaluate a parsed query against a dictionary of columns, as built by
+    HeaderIndex.columns(). Returns a boolean array.
+    """
+
+    if node[0] == 'and':
+        return _evaluate(node[1], columns, aliases) & \
+            _evaluate(node[2], columns, aliases)
+    if node[0] == 'or':
+        return _evaluate(node[1], columns, aliases) | \
+            _evaluate(node[2], columns, aliases)
+    if node[0] == 'not':
+        return ~_evaluate(node[1], columns, aliases)
+
+    op, key = node[:2]
+    # a query keyword may stand for several header keywords
+    if key in aliases:
+        result = _evaluate((op, aliases[key][0]) + node[2:], columns, {})
+        for kw in aliases[key][1:]:
+            result |= _evaluate((op, kw) + node[2:], columns, {})
+        return result
+
+    numeric, strings, present = columns[key]
+    if op == '~':
+        pattern = _re.compile(node[2])
+        return _np.array([bool(p) and pattern.search(s) is not None
+                          for s, p in zip(strings, present)], dtype=bool)
+    if op == 'in':
+        result = _np.zeros(len(present), dtype=bool)
+        for val in node[2]:
+            result |= _evaluate(('=', key, val), columns, {})
+        return result
+    if op == 'between':
+        return _evaluate(('>=', key, node[2]), columns, {}) & \
+            _evaluate(('<=', key, node[3]), columns, {})
+
+    num = _number(node[2])
+    if op in ['=', '!=']:
+        # numbers compare numerically, but e.g. OBJECT = 123 should still
+        # match a string value
+        equal = (strings == node[2]) & _np.isnan(numeric) & present
+        if num is not None:
+            equal |= numeric == num
+        if op == '=':
+            return equal
+        return present & ~equal
+    if num is not None:
+        # missing and non-numeric values compare as NaN, never matching
+        with _np.errstate(invalid='ignore'):
+            return _compare(op, numeric, num)
+    return _compare(op, strings, node[2]) & present
+
+
+class HeaderIndex(object):
+    """
+    Cache of selected primary header keywords for a set of FITS files.
+
+    Entries are keyed on the absolute path of each file and are re-read
+    only when the file's size or modification time changes, or when a
+    keyword that has not been recorded for it yet is requested.
+
+    Arguments:
+      dbname: SQLite file to keep the index in (default: '.fitsindex.db'
+              in the current directory). Use ':memory:' for no cache.
+      keywords: keywords to record by default
+      threads: number of files to check and read concurrently (default: 8),
+               which hides the latency of network file systems
+    """
+
+    def __init__(self, dbname='.fitsindex.db', keywords=(), threads=8):
+        self.keywords = list(keywords)
+        self.threads = threads
+        self.db = _sqlite3.connect(dbname)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta \
+(name TEXT PRIMARY KEY, value INTEGER)')
+        row = self.db.execute("SELECT value FROM meta WHERE name='schema'")
+        row = row.fetchone()
+        if row is None or row[0] != _SCHEMA:
+            self.db.execute('DROP TABLE IF EXISTS headers')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES \
+('schema', ?)", (_SCHEMA,))
+        self.db.execute('CREATE TABLE IF NOT EXISTS headers \
+(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, keywords TEXT)')
+        self.db.commit()
+
+    def close(self):
+        """
+        Close the index file.
+        """
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cached(self, paths):
+        """
+        Return the stored entries for a list of absolute paths.
+        """
+        rows = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start+500]
+            query = 'SELECT path, size, mtime, keywords FROM headers \
+WHERE path IN (' + ','.join('?' * len(chunk)) + ')'
+            for path, size, mtime, kws in self.db.execute(query, chunk):
+                rows[path] = (size, mtime, _json.loads(kws))
+        return rows
+
+    def refresh(self, files, keywords=None):
+        """
+        Bring the index up to date for a list of files, reading the headers
+        of only new or changed files.
+
+        Returns a list of (file, keyword dictionary) in the order given. The
+        dictionary is None for files which do not exist or cannot be read.
+        """
+
+        keywords = list(keywords or self.keywords)
+        paths = [_os.path.abspath(fname) for fname in files]
+        unique = list(dict.fromkeys(paths))
+        rows = self._cached(unique)
+        checked = dict(zip(unique, _threadmap(
+            lambda path: _check(path, rows.get(path), keywords), unique,
+            threads=self.threads)))
+        result = [(fname, checked[path][0])
+                  for fname, path in zip(files, paths)]
+        updates = dict((path, entry) for path, (values, entry) in
+                       checked.items() if entry is not None)
+        if updates:
+            self.db.executemany('INSERT OR REPLACE INTO headers VALUES \
+(?, ?, ?, ?)', [(path, size, mtime, _json.dumps(values))
+                for path, (size, mtime, values) in updates.items()])
+            self.db.commit()
+
+        return result
+
+    def headers(self, files, keywords=None):
+        """
+        Return a dictionary of file: keyword dictionary, for the files
+        which could be read.
+        """
+
+        return dict((fname, values) for fname, values in
+                    self.refresh(files, keywords=keywords)
+                    if values is not None)
+
+    def select(self, files, criteria):
+        """
+        Return the files (in the order given) whose keywords match all of
+        the given criteria, a dictionary of keyword: regular expression.
+        Keyword values are compared as strings with re.search().
+        """
+
+        selected = []
+        for fname, values in self.refresh(files, keywords=list(criteria)):
+            if values is None:
+                continue
+            if all(values[kw] is not None and
+                   _re.search(pattern, str(values[kw]))
+                   for kw, pattern in criteria.items()):
+                selected.append(fname)
+        return selected
+
+    def classify(self, files, keyword):
+        """
+        Group files by the value of a keyword.
+
+        Returns a dictionary of value: list of files. Files without the
+        keyword are listed under None.
+        """
+
+        groups = {}
+        for fname, values in self.refresh(files, keywords=[keyword]):
+            if values is not None:
+                groups.setdefault(values[keyword], []).append(fname)
+        return groups
+
+    def columns(self, files, keywords=None):
+        """
+        Build a columnar view of the index for a list of files.
+
+        Returns the list of readable files and a dictionary of keyword:
+        (numeric values, string values, present), each an array with one
+        entry per file. Non-numeric and missing values are NaN in the
+        numeric column.
+        """
+
+        keywords = list(keywords or self.keywords)
+        # record the default keywords too, so later queries on them do not
+        # need to re-read the files
+        entries = [(fname, values) for fname, values in
+                   self.refresh(files, keywords=self.keywords +
+                                [kw for kw in keywords
+                                 if kw not in self.keywords])
+                   if values is not None]
+        columns = {}
+        for kw in keywords:
+            vals = [values[kw] for fname, values in entries]
+            numeric = _np.array([float(val) if isinstance(val, (int, float))
+                                 and not isinstance(val, bool) else _np.nan
+                                 for val in vals], dtype=float)
+            strings = _np.array(['' if val is None else str(val).strip()
+                                 for val in vals], dtype=str)
+            present = _np.array([val is not None for val in vals], dtype=bool)
+            columns[kw] = (numeric, strings, present)
+
+        return [fname for fname, values in entries], columns
+
+    def query(self, files, queries, aliases=None):
+        """
+        Select files with one or more queries (see parseQuery()).
+
+        queries may be a single query or a list of them, answered from a
+        single pass over the index. aliases is an optional dictionary of
+        query keyword: list of header keywords, which matches if any of
+        the header keywords does (e.g. {'FILTER': ['FILTER1', 'FILTER2']}).
+
+        Returns the list of selected files (in the order given), or a list
+        of such lists if a list of queries was given.
+        """
+
+        aliases = aliases or {}
+        single = isinstance(queries, str) or isinstance(queries, tuple)
+        if single:
+            queries = [queries]
+        trees = [parseQuery(query) if isinstance(query, str) else query
+                 for query in queries]
+        keywords = []
+        for tree in trees:
+            for kw in queryKeywords(tree):
+                for hkw in aliases.get(kw, [kw]):
+                    if not(hkw in keywords):
+                        keywords.append(hkw)
+        fnames, columns = self.columns(files, keywords=keywords)
+        selected = []
+        for tree in trees:
+            mask = _evaluate(tree, columns, aliases)
+            selected.append([fname for fname, sel in zip(fnames, mask)
+                             if sel])
+
+        if single:
+            return selected[0]
+        return selected
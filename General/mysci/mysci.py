@@ -135,6 +135,87 @@ restfreq = {'HI': 1420405751.77*_u.Hz,
 # - pyfits import, transpose the data to RA,Dec,Spectral,[Stokes]
 #   (see http://www.cv.nrao.edu/~aleroy/pytut/topic2/intro_fits_files.py)
 
+def _isnumeric(field):
+    """
+    Element-wise check that a string array holds plain (optionally signed)
+    decimal numbers. Empty strings and repeated signs are rejected.
+    """
+    # at most one sign, which lstrip() removes if it is the leading character
+    onesign = (_np.char.count(field, '+') + _np.char.count(field, '-')) <= 1
+    field = _np.char.lstrip(field, '+-')
+    field = _np.char.replace(field, '.', '', count=1)
+    return onesign & _np.char.isdigit(field)
+
+
+def SegtoDecimalArray(seg, RA=False):
+    """
+    Vectorized version of SegtoDecimal(). Convert a list or array of
+    segidecimal strings to decimal values in a single pass.
+
+    Accepts colon, whitespace, h/m/s (RA=True), d/m/s (RA=False) and CASA
+    period-separated (RA=False) formats, which may be mixed within the input.
+
+    Returns a tuple of:
+        - deci: float64 Quantity array (degrees), nan for rows which failed
+        - err: integer array of per-row error codes
+            0 - no error
+            1 - string could not be parsed
+            2 - negative RA
+            3 - RA greater than 24 hours
+
+    Rows which fail do not affect the others:
+
+    >>> SegtoDecimalArray(['-5:3:3', '--5:3:3', '+-1 2 3'])[1]
+    array([0, 1, 1])
+    """
+    seg = _np.char.strip(_np.asarray(seg, dtype=str))
+    if seg.ndim == 0:
+        seg = seg.reshape(1)
+
+    # normalize all supported separators to single spaces
+    colon = _np.char.find(seg, ':') >= 0
+    seg = _np.char.replace(seg, ':', ' ')
+    if RA:
+        seg = _np.char.replace(seg, 'h', ' ')
+    else:
+        # period-separated (CASA format) only if nothing else matched
+        casa = ~colon & (_np.char.find(seg, 'd') < 0) & \
+               (_np.char.count(seg, '.') > 1)
+        seg = _np.where(casa, _np.char.replace(seg, '.', ' ', count=2), seg)
+        seg = _np.char.replace(seg, 'd', ' ')
+    seg = _np.char.replace(seg, 'm', ' ')
+    seg = _np.char.rstrip(seg, 's')
+    seg = _np.char.replace(seg, '\t', ' ')
+    while _np.any(_np.char.find(seg, '  ') >= 0):
+        seg = _np.char.replace(seg, '  ', ' ')
+    seg = _np.char.strip(seg)
+
+    # split into the three components
+    part = _np.char.partition(seg, ' ')
+    T1 = part[..., 0]
+    part = _np.char.partition(part[..., 2], ' ')
+    T2 = part[..., 0]
+    T3 = part[..., 2]
+
+    good = _isnumeric(T1) & _isnumeric(T2) & _isnumeric(T3)
+    T1 = _np.where(good, T1, 'nan').astype(_np.float64)
+    T2 = _np.where(good, T2, 'nan').astype(_np.float64)
+    T3 = _np.where(good, T3, 'nan').astype(_np.float64)
+
+    # sign comes from the leading character, so "-0" is handled properly
+    sign = _np.where(_np.char.startswith(seg, '-'), -1.0, 1.0)
+    deci = T1 + sign * (T2 / 60. + T3 / 3600.)
+
+    err = _np.where(good, 0, 1)
+    if RA:
+        err = _np.where(good & (sign < 0), 2, err)
+        err = _np.where(good & (T1 > 24.), 3, err)
+        deci *= 15
+    deci[err != 0] = _np.nan
+
+    return deci * _u.deg, err
+
+
 def SegtoDecimal(seg, RA=False):
     """
     Input a segidecimal angle (can't be hours!), return a decimal value
@@ -142,57 +223,23 @@ def SegtoDecimal(seg, RA=False):
     seg is a string, with the values separated by a colon
     RA=False if it's an angle, RA=True if it's hours,mins,seconds
 
+    This is a wrapper around SegtoDecimalArray(); use that directly for
+    converting catalog columns.
     """
-    # colon separated (RA or Dec)
-    if _re.search(":", seg):
-        seg = seg.split(":")
-    # h m s separated (should only be RA)
-    elif RA and _re.search("h", seg):
-        temp = seg.split("h")
-        seg = []
-        seg.append(temp[0])
-        temp = temp[1].split('m')
-        seg.append(temp[0])
-        temp = temp[1].split('s')[0]
-        seg.append(temp)
-    # d m s separated (should only be Dec)
-    elif not(RA) and _re.search("d", seg):
-        temp = seg.split("d")
-        seg = []
-        seg.append(temp[0])
-        temp = temp[1].split('m')
-        seg.append(temp[0])
-        temp = temp[1].split('s')[0]
-        seg.append(temp)
-    # period-separated (Dec, CASA format)
-    elif not(RA) and len(seg.split('.')) > 2:
-        temp = seg.split('.')
-        seg = []
-        seg.append(temp[0])
-        seg.append(temp[1])
-        seg.append('.'.join(temp[2:])) # re-attach seconds of Dec
-    # whitespace separated (RA or Dec)
-    else:
-        seg = seg.split()
-    if float(seg[0]) == 0:
-        if seg[0][0] == '-':
-            sign = -1.0
-        else:
-            sign = 1.0
-    else:
-        sign = _np.sign(float(seg[0]))
-    if sign < 0 and RA:
+    deci, err = SegtoDecimalArray(seg, RA=RA)
+    if err[0] == 1:
+        _sys.stderr.write("Could not parse " + str(seg) +
+                          " as a segidecimal value. Returning nan.\n")
+        return _np.nan
+    if err[0] == 2:
         _sys.stderr.write("Uh, RA has a negative value. That's weird. Returning nan.\n")
         return _np.nan
-    if RA and float(seg[0]) > 24.:
+    if err[0] == 3:
         _sys.stderr.write("RA is greater than 24 hours. \
 Are you sure you're passing the correct arguments?\n")
         return _np.nan
-    deci = float(seg[0]) + sign * (float(seg[1]) / 60. + float(seg[2]) /3600.)
-    if RA:
-        deci *= 15
 
-    return deci * _u.deg
+    return deci[0]
 
 def DecimaltoSeg(deci, RA=False):
     """
@@ -215,6 +262,104 @@ def DecimaltoSeg(deci, RA=False):
 
     return seg
 
+def DecimaltoSegArray(deci, RA=False, precision=2, out=None):
+    """
+    Vectorized, fixed-width version of DecimaltoSeg(). Convert an array of
+    decimal angles (in degrees) to segidecimal strings in a single pass.
+
+    Arguments:
+        - deci: array of decimal values (or a Quantity array)
+        - RA: if True, values are converted to hours:min:seconds
+        - precision: number of decimals for the seconds field
+        - out: optional preallocated numpy 'S' or 'U' array with at least
+            as many characters as the output width. Filled in place.
+
+    Seconds are rounded to precision before formatting, so 60 seconds carries
+    into the next minute (and minutes into degrees/hours), and RA hours wrap
+    around at 24h. Dec values always carry a sign, including -0. Rows with
+    non-finite input are set to 'nan'.
+
+    Returns the array of strings.
+    """
+    if isinstance(deci, _u.Quantity):
+        deci = deci.to(_u.deg).value
+    deci = _np.asarray(deci, dtype=_np.float64)
+    shape = deci.shape
+    deci = deci.ravel()
+    good = _np.isfinite(deci)
+
+    neg = _np.signbit(deci)
+    deci = _np.where(good, _np.abs(deci), 0.)
+    if RA:
+        deci = deci / 15.
+
+    # work in integer units of the last printed digit
+    fac = 10**precision
+    ticks = _np.round(deci * (3600 * fac)).astype(_np.int64)
+    T1 = ticks // (3600 * fac)
+    ticks = ticks - T1 * (3600 * fac)
+    T2 = ticks // (60 * fac)
+    T3 = ticks - T2 * (60 * fac)
+    if RA:
+        # values rounding up to 24h are 00h
+        T1 = T1 % 24
+
+    # character layout: [sign] degrees ':' MM ':' SS ['.' decimals]
+    hassign = not(RA) or bool(_np.any(neg & good))
+    ndeg = max(2, len(str(int(T1.max())))) if len(T1) else 2
+    width = int(hassign) + ndeg + 6 + (precision + 1 if precision > 0 else 0)
+
+    chars = _np.empty((len(deci), width), dtype=_np.uint8)
+    col = 0
+    if hassign:
+        chars[:, 0] = _np.where(neg, ord('-'), ord('+'))
+        col = 1
+    for i in range(ndeg - 1, -1, -1):
+        chars[:, col + i] = ord('0') + T1 % 10
+        T1 = T1 // 10
+    col += ndeg
+    chars[:, col] = ord(':')
+    chars[:, col + 1] = ord('0') + T2 // 10
+    chars[:, col + 2] = ord('0') + T2 % 10
+    chars[:, col + 3] = ord(':')
+    col += 4
+    sec = T3 // fac
+    chars[:, col] = ord('0') + sec // 10
+    chars[:, col + 1] = ord('0') + sec % 10
+    col += 2
+    if precision > 0:
+        chars[:, col] = ord('.')
+        frac = T3 - sec * fac
+        for i in range(precision, 0, -1):
+            chars[:, col + i] = ord('0') + frac % 10
+            frac = frac // 10
+    chars[~good] = 0
+    chars[~good, :3] = _np.frombuffer(b'nan', dtype=_np.uint8)
+
+    if out is None:
+        out = _np.empty(shape, dtype='S' + str(width))
+    if out.size != len(deci):
+        raise ValueError('out has ' + str(out.size) + ' elements, need ' +
+                         str(len(deci)))
+    if out.dtype.kind == 'S':
+        ctype = _np.uint8
+        csize = out.dtype.itemsize
+    elif out.dtype.kind == 'U':
+        ctype = _np.uint32
+        csize = out.dtype.itemsize // 4
+    else:
+        raise TypeError('out must be a numpy string (S or U) array')
+    if not(out.flags.c_contiguous):
+        raise ValueError('out must be C-contiguous')
+    if csize < width:
+        raise ValueError('out is too narrow, need at least ' + str(width) +
+                         ' characters')
+    view = out.reshape(-1).view(ctype).reshape(len(deci), csize)
+    view[:, :width] = chars
+    view[:, width:] = 0
+
+    return out
+
 def RedshiftLine(z, restlam=None, restnu=None):
     """
 
@@ -232,7 +377,69 @@ def RedshiftLine(z, restlam=None, restnu=None):
         _sys.stderr.write("Error: frequency not specified. Returning nan.\n")
         return _np.nan
 
-def fitsopen(fname, mode='readonly', ext=0, trim=0, quiet=True):
+def _scaling(header, raw):
+    """
+    Return BSCALE, BZERO, BLANK (None for floating point data) of an image
+    and the dtype astropy would give the scaled data (None if the data does
+    not need scaling).
+    """
+
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    blank = None
+    if raw.dtype.kind in 'iu':
+        blank = header.get('BLANK')
+    if bscale == 1 and bzero == 0 and blank is None:
+        return bscale, bzero, blank, None
+
+    bits = raw.dtype.itemsize * 8
+    if bscale == 1 and blank is None:
+        # FITS conventions for unsigned (and signed byte) integers
+        if raw.dtype.kind == 'u' and bzero == -128:
+            return bscale, bzero, blank, _np.dtype('int8')
+        if raw.dtype.kind == 'i' and bits > 8 and bzero == 1 << (bits - 1):
+            return bscale, bzero, blank, _np.dtype('uint' + str(bits))
+    if raw.dtype.kind == 'f':
+        return bscale, bzero, blank, raw.dtype.newbyteorder('=')
+    if bits > 16:
+        return bscale, bzero, blank, _np.dtype('float64')
+    return bscale, bzero, blank, _np.dtype('float32')
+
+
+def _scaleraw(raw, header, dtype=None, out=None):
+    """
+    Apply BSCALE/BZERO/BLANK to raw (unscaled) image data, converting it to
+    dtype (default: as astropy would). The scaling is done in place on a
+    single converted copy, or on out if given. Data that needs neither
+    scaling nor conversion is returned as is, without a copy.
+    """
+
+    bscale, bzero, blank, sdtype = _scaling(header, raw)
+    if out is None:
+        if dtype is None:
+            if sdtype is None:
+                return raw
+            dtype = sdtype
+        dtype = _np.dtype(dtype)
+        if sdtype is None and dtype == raw.dtype:
+            return raw
+        out = _np.empty(raw.shape, dtype=dtype.newbyteorder('='))
+    # integer outputs wrap around, as needed for unsigned integers
+    _np.copyto(out, raw, casting='unsafe')
+    if bscale != 1:
+        _np.multiply(out, bscale, out=out, casting='unsafe')
+    if bzero != 0:
+        _np.add(out, bzero, out=out, casting='unsafe')
+    if blank is not None and out.dtype.kind == 'f':
+        # a row at a time, to avoid a full-size mask
+        for row in range(raw.shape[0]):
+            out[row][raw[row] == blank] = _np.nan
+
+    return out
+
+
+def fitsopen(fname, mode='readonly', ext=0, trim=0, quiet=True, native=False,
+             dtype=None):
     """
 
     Opens a fits file using pyfits (with an optional specification of the mode).
@@ -242,6 +449,15 @@ def fitsopen(fname, mode='readonly', ext=0, trim=0, quiet=True):
 
     ext specifies the FITS extension to use
     trim=0 won't trim the image according to the TRIMSEC keyword, 1 will.
+    native=True returns the array in the FITS (y, x) order, without the
+    transpose.
+    dtype sets the data type of the returned array (default: that of the
+    file, or the type astropy would use for data with BZERO/BSCALE).
+
+    The file is memory-mapped, so if the data needs no scaling or conversion
+    the returned array is a view of the file (copy-on-write for
+    mode='readonly'). Otherwise only the (trimmed) data is copied once and
+    scaled in place.
 
     If quiet=True, no output is printed. If quiet is False, status messages are written
     to stdout.
@@ -249,15 +465,16 @@ def fitsopen(fname, mode='readonly', ext=0, trim=0, quiet=True):
 
     # make sure the file exists
     if _os.path.isfile(fname):
-        frame = _pyfits.open(fname, mode=mode)
+        frame = _pyfits.open(fname, mode=mode, do_not_scale_image_data=True)
         # we should really make sure we have enough extensions to open the one we
         # want, but i'll leave that for later. :)
-        idata = frame[ext].data.transpose()
+        raw = frame[ext].data
         if trim:
-            trimsec = frame[ext].header['TRIMSEC'] #should really check this exists...
-            # split it
-            range = [int(s) for s in _re.findall(r'\d+', trimsec)]
-            idata = idata[range[0]-1:range[1], range[2]-1:range[3]]
+            trimsec = _trimslices(frame[ext].header)
+            raw = raw[trimsec[1], trimsec[0]]
+        idata = _scaleraw(raw, frame[ext].header, dtype=dtype)
+        if not native:
+            idata = idata.transpose()
         frame.close()
     else:
         _sys.stderr.write('Error: ' + fname + ' not found.')
@@ -278,20 +495,92 @@ def quadsum(values):
         tot += item**2
     return _np.sqrt(tot)
 
-def angDist(pos1, pos2):
+def _torad(val):
     """
-    Calculate the angular distance between two points. Require decimal positions
+    Strip units from an angle, returning a float64 array in radians. Values
+    without units are assumed to already be in radians.
+    """
+    if isinstance(val, _u.Quantity):
+        return _np.asarray(val.to(_u.rad).value, dtype=_np.float64)
+    return _np.asarray(val, dtype=_np.float64)
+
+def _vincenty(coslat1, sinlat1, coslat2, sinlat2, cosdlon, sindlon):
     """
-    numer = _np.sqrt((_np.cos(pos2[0]) * _np.sin(_np.abs(pos1[1] - \
-                      pos2[1])))**2 + \
-                     (_np.cos(pos1[0]) * _np.sin(pos2[0]) - \
-                      _np.sin(pos1[0]) * _np.cos(pos2[0]) * \
-                      _np.cos(_np.abs(pos1[1] - pos2[1])))**2)
-    denom = _np.sin(pos1[0]) * _np.sin(pos2[0]) + \
-            _np.cos(pos1[0]) * _np.cos(pos2[0]) * \
-            _np.cos(_np.abs(pos1[1] - pos2[1]))
+    Vincenty angular distance from precomputed trig values.
+    """
+    numer = _np.hypot(coslat2 * sindlon,
+                      coslat1 * sinlat2 - sinlat1 * coslat2 * cosdlon)
+    denom = sinlat1 * sinlat2 + coslat1 * coslat2 * cosdlon
     return _np.arctan2(numer, denom)
 
+def angDist(pos1, pos2, pairwise=False, chunk=None, out=None):
+    """
+    Calculate the angular distance between two points. Require decimal positions
+
+    Positions are given as (lat, lon) pairs. Each element may be a scalar or
+    an array, and are broadcast against each other (e.g., one-to-many).
+    Quantities are converted to radians once on input; plain numbers are
+    assumed to be in radians. If any input has units, the result is a
+    Quantity in radians.
+
+    Optional arguments:
+        - pairwise: if True, pos1 (N) and pos2 (M) are flattened and the full
+            N x M separation matrix is returned.
+        - chunk: (pairwise only) number of pos1 rows to compute at a time,
+            bounding temporary memory to ~chunk x M values.
+        - out: (pairwise only) preallocated N x M array to fill, e.g. a
+            numpy.memmap for matrices which don't fit in memory.
+    """
+    hasunits = any(isinstance(p, _u.Quantity)
+                   for p in (pos1[0], pos1[1], pos2[0], pos2[1]))
+    lat1 = _torad(pos1[0])
+    lon1 = _torad(pos1[1])
+    lat2 = _torad(pos2[0])
+    lon2 = _torad(pos2[1])
+
+    if pairwise:
+        # pos1 along rows, pos2 along columns
+        lat1, lon1 = [x.reshape(-1, 1)
+                      for x in _np.broadcast_arrays(lat1, lon1)]
+        lat2, lon2 = [x.reshape(1, -1)
+                      for x in _np.broadcast_arrays(lat2, lon2)]
+
+    coslat1 = _np.cos(lat1)
+    sinlat1 = _np.sin(lat1)
+    coslat2 = _np.cos(lat2)
+    sinlat2 = _np.sin(lat2)
+
+    if not(pairwise):
+        dlon = lon1 - lon2
+        dist = _vincenty(coslat1, sinlat1, coslat2, sinlat2,
+                         _np.cos(dlon), _np.sin(dlon))
+    else:
+        # longitude differences from the angle-difference identities, so no
+        # trig is evaluated on the N x M grid
+        coslon1 = _np.cos(lon1)
+        sinlon1 = _np.sin(lon1)
+        coslon2 = _np.cos(lon2)
+        sinlon2 = _np.sin(lon2)
+        shape = (lat1.shape[0], lat2.shape[1])
+        if out is None:
+            out = _np.empty(shape, dtype=_np.float64)
+        elif out.shape != shape:
+            raise ValueError('out has shape ' + str(out.shape) +
+                             ', need ' + str(shape))
+        if chunk is None:
+            chunk = shape[0]
+        for i in range(0, shape[0], chunk):
+            rows = slice(i, i + chunk)
+            cosdlon = coslon1[rows] * coslon2 + sinlon1[rows] * sinlon2
+            sindlon = sinlon1[rows] * coslon2 - coslon1[rows] * sinlon2
+            out[rows] = _vincenty(coslat1[rows], sinlat1[rows],
+                                  coslat2, sinlat2, cosdlon, sindlon)
+        dist = out
+
+    if hasunits:
+        return dist * _u.rad
+    return dist
+
 def HImass(flux, DL):
     """
     HImass(flux,DL)
@@ -432,6 +721,20 @@ def querySIMBAD(name):
 ###############################################################################
 # Catalog Functions
 
+def _poscoord(val, RA=False):
+    """
+    Homogenize one coordinate of a position for PosMatch(). Segidecimal
+    strings (str or bytes, e.g. from FITS tables) are parsed, plain numbers
+    are taken as degrees and Quantities are returned as they are.
+    """
+    if isinstance(val, (bytes, _np.bytes_)):
+        val = val.decode()
+    if isinstance(val, (str, _np.str_)):
+        return SegtoDecimal(val, RA=RA)
+    elif not(isinstance(val, _u.Quantity)):
+        return val * _u.deg
+    return val
+
 def PosMatch(pos1, pos2, posTol=60.*_u.arcsec):
     """
     Position matching function for catalogs.
@@ -444,30 +747,99 @@ def PosMatch(pos1, pos2, posTol=60.*_u.arcsec):
     """
 
     # homogenize positions
-    if type(pos1[0]) is str or type(pos1[0]) is _np.string_:
-        pos1[0] = SegtoDecimal(pos1[0], RA=True)
-    elif not(type(pos1[0]) is _u.quantity.Quantity):
-        pos1[0] *= _u.deg
-    if type(pos1[1]) is str or type(pos1[1]) is _np.string_:
-        pos1[1] = SegtoDecimal(pos1[1], RA=False)
-    elif not(type(pos1[1]) is _u.quantity.Quantity):
-        pos1[1] *= _u.deg
-    if type(pos2[0]) is str or type(pos2[0]) is _np.string_:
-        pos2[0] = SegtoDecimal(pos2[0], RA=True)
-    elif not(type(pos2[0]) is _u.quantity.Quantity):
-        pos2[0] *= _u.deg
-    if type(pos2[1]) is str or type(pos2[1]) is _np.string_:
-        pos2[1] = SegtoDecimal(pos2[1], RA=False)
-    elif not(type(pos2[1]) is _u.quantity.Quantity):
-        pos2[1] *= _u.deg
+    for pos in (pos1, pos2):
+        pos[0] = _poscoord(pos[0], RA=True)
+        pos[1] = _poscoord(pos[1], RA=False)
 
     # determine posTol character and homogenize
-    if not(type(posTol) is _u.quantity.Quantity):
+    if not(isinstance(posTol, _u.Quantity)):
         _sys.stderr.write("WARNING: No units given for posTol, assuming arcsec.\n")
         posTol *= _u.arcsec
 
     return bool(angDist(pos1, pos2) < posTol)
 
+def _catcoords(cat):
+    """
+    Homogenize a catalog given as (RA, Dec) columns into float64 arrays of
+    radians. Columns may be segidecimal strings, Quantities or plain decimal
+    degrees.
+    """
+    out = []
+    for col, RA in zip(cat, (True, False)):
+        if isinstance(col, _u.Quantity):
+            col = col.to(_u.rad).value
+        else:
+            col = _np.asarray(col)
+            if col.dtype.kind in 'SUO':
+                col = SegtoDecimalArray(col.astype(str), RA=RA)[0]
+                col = col.to(_u.rad).value
+            else:
+                col = _np.radians(col.astype(_np.float64))
+        out.append(_np.atleast_1d(col))
+    return out
+
+def _unitvec(ra, dec):
+    """
+    Convert RA, Dec (radians) to an (N, 3) array of Cartesian unit vectors.
+    """
+    cosdec = _np.cos(dec)
+    return _np.column_stack((cosdec * _np.cos(ra),
+                             cosdec * _np.sin(ra),
+                             _np.sin(dec)))
+
+def CatMatch(cat1, cat2, posTol=60.*_u.arcsec, nearest=True):
+    """
+    Cross-match two catalogs using a KD-tree on unit vectors.
+
+    Parameters:
+        - cat1, cat2: catalogs as (RA, Dec) pairs of columns. Columns can be
+            segidecimal strings, Quantities or decimal degrees.
+        - posTol: position tolerance (in arcsec if no units defined;
+            default 60")
+        - nearest: if True, return only the nearest cat2 source for each cat1
+            source. If False, return all pairs within posTol.
+
+    Returns a tuple of (idx1, idx2, sep): index arrays into cat1 and cat2 and
+    the angular separations (as a Quantity), computed with angDist().
+    """
+    from scipy.spatial import cKDTree
+
+    if not(isinstance(posTol, _u.Quantity)):
+        _sys.stderr.write("WARNING: No units given for posTol, assuming arcsec.\n")
+        posTol *= _u.arcsec
+    tol = posTol.to(_u.rad).value
+    # chord length corresponding to the angular tolerance
+    chord = 2. * _np.sin(min(tol, _np.pi) / 2.)
+
+    ra1, dec1 = _catcoords(cat1)
+    ra2, dec2 = _catcoords(cat2)
+    good2 = _np.flatnonzero(_np.isfinite(ra2) & _np.isfinite(dec2))
+    tree = cKDTree(_unitvec(ra2[good2], dec2[good2]))
+    good1 = _np.flatnonzero(_np.isfinite(ra1) & _np.isfinite(dec1))
+    xyz1 = _unitvec(ra1[good1], dec1[good1])
+
+    if nearest:
+        dist, idx = tree.query(xyz1, k=1, distance_upper_bound=chord)
+        found = _np.isfinite(dist)
+        idx1 = good1[found]
+        idx2 = good2[idx[found]]
+    else:
+        hits = tree.query_ball_point(xyz1, chord)
+        nhits = _np.array([len(h) for h in hits], dtype=_np.intp)
+        idx1 = _np.repeat(good1, nhits)
+        if nhits.sum():
+            idx2 = good2[_np.concatenate(hits).astype(_np.intp)]
+        else:
+            idx2 = _np.zeros(0, dtype=_np.intp)
+
+    # final separations with angDist (positions given as (lat, lon))
+    sep = angDist((dec1[idx1], ra1[idx1]), (dec2[idx2], ra2[idx2]))
+    # drop anything let through by rounding in the chord comparison
+    keep = sep <= tol
+    sep = sep[keep] * _u.rad
+
+    return idx1[keep], idx2[keep], sep.to(posTol.unit)
+
 # End Catalog Functions
 ###############################################################################
 
@@ -476,63 +848,370 @@ def PosMatch(pos1, pos2, posTol=60.*_u.arcsec):
 #
 # Wrappers for various things. May require functions listed above
 
-def Telload(fname, Tel='none', mode='readonly', quiet=True):
+def _trimslices(header, key='TRIMSEC'):
+    """
+    Return the TRIMSEC (or another section, e.g. BIASSEC) of an extension
+    as slices of the transposed (x, y) image.
+    """
+
+    # should really check this exists...
+    rng = [int(s) for s in _re.findall(r'\d+', header[key])]
+    return (slice(rng[0]-1, rng[1]), slice(rng[2]-1, rng[3]))
+
+
+class Instrument(object):
     """
+    Description of how an instrument's frames are laid out and classified.
 
-    Wrapper function for fitsopen(). Will load and appropriately arrange a fits
-    file based on the specific telescope.
+    Arguments:
+      name: name used to select the instrument (e.g. Tel= in Telload())
+      description: for status messages
+      exts: FITS extensions holding the amplifiers, 'primary' (default),
+            'all' (every extension after the primary) or a list
+      layout: how Telload() arranges the amplifiers, 'single' (one
+              amplifier), 'side' (side by side in x) or 'stack' (a 3D stack)
+      transpose: return images in (x, y) order (default: True)
+      trim: trim amplifiers to their TRIMSEC (default: False)
+      flip: amplifiers to flip in x, e.g. those reading out the other way
+      overscan: header keyword with the overscan section (e.g. 'BIASSEC')
+      imgkey: header keyword with the image type (bias, flat, ...)
+      filterkeys: header keywords with the filter(s)
+      keywords: header keywords needed to classify frames (default: imgkey
+                and filterkeys)
+      lazy: whether Telload() returns per-amplifier views (TelAmps) by
+            default instead of a mosaic
+
+    imaging is True for instruments whose frames can be sorted into
+    bias/flat/object frames per filter (those with an imgkey and filterkeys).
+
+    Load plans (extensions, slices, output geometry) are derived from the
+    headers once for each distinct frame geometry and cached.
+    """
+
+    def __init__(self, name, description=None, exts='primary',
+                 layout='single', transpose=True, trim=False, flip=(),
+                 overscan=None, imgkey='IMAGETYP', filterkeys=('FILTER',),
+                 keywords=None, lazy=False):
+        self.name = name
+        self.description = description or name
+        self.exts = exts
+        self.layout = layout
+        self.transpose = transpose
+        self.trim = trim
+        self.flip = list(flip)
+        self.overscan = overscan
+        self.imgkey = imgkey
+        self.filterkeys = list(filterkeys)
+        if keywords is None:
+            keywords = [kw for kw in [imgkey] + self.filterkeys if kw]
+        self.keywords = list(keywords)
+        self.lazy = lazy
+        self._plans = {}
+
+    @property
+    def imaging(self):
+        return bool(self.imgkey) and len(self.filterkeys) > 0
+
+    def _extlist(self, nHDU):
+        """
+        Return the extensions holding the amplifiers.
+        """
+        if self.exts == 'primary':
+            return [0]
+        elif self.exts == 'all':
+            return list(range(1, nHDU))
+        return list(self.exts)
+
+    def plan(self, frame):
+        """
+        Return the load plan for an open frame (an HDUList), computing it
+        only for frame geometries not seen before.
+
+        The plan is a dictionary with the extensions ('exts'), the slices
+        of the raw (y, x) data of each amplifier, with flips ('slices'),
+        the overscan slices of the raw data ('overscan', None if there is
+        no overscan section), the shape of the Telload() output ('shape')
+        and where each amplifier goes in it ('place').
+        """
+
+        exts = self._extlist(len(frame))
+        key = tuple((ext, frame[ext].header.get('NAXIS1'),
+                     frame[ext].header.get('NAXIS2'),
+                     self.trim and frame[ext].header.get('TRIMSEC'),
+                     self.overscan and frame[ext].header.get(self.overscan))
+                    for ext in exts)
+        if key in self._plans:
+            return self._plans[key]
+
+        slices = []
+        overscan = []
+        shapes = []
+        for amp, ext in enumerate(exts):
+            header = frame[ext].header
+            ny, nx = header['NAXIS2'], header['NAXIS1']
+            xsl, ysl = slice(0, nx), slice(0, ny)
+            if self.trim:
+                xsl, ysl = _trimslices(header)
+            if amp in self.flip:
+                xsl = slice(xsl.stop - 1, xsl.start - 1 if xsl.start else None,
+                            -1)
+            slices.append((ysl, xsl))
+            shapes.append((len(range(ny)[ysl]), len(range(nx)[xsl])))
+            if self.overscan and self.overscan in header:
+                oxsl, oysl = _trimslices(header, key=self.overscan)
+                overscan.append((oysl, oxsl))
+            else:
+                overscan.append(None)
+
+        if self.layout == 'side':
+            # side by side in x
+            widths = [shape[1] for shape in shapes]
+            shape = (shapes[0][0], sum(widths))
+            place = [(slice(None), slice(sum(widths[:amp]),
+                                         sum(widths[:amp+1])))
+                     for amp in range(len(exts))]
+        elif self.layout == 'stack':
+            shape = (len(exts),) + shapes[0]
+            place = [amp for amp in range(len(exts))]
+        else:
+            shape = shapes[0]
+            place = [Ellipsis]
+        if self.transpose:
+            # images are returned in (x, y) order
+            if self.layout == 'stack':
+                shape = (shape[0], shape[2], shape[1])
+            else:
+                shape = shape[::-1]
+                place = [pl if pl is Ellipsis else pl[::-1] for pl in place]
+
+        plan = {'exts': exts, 'slices': slices, 'overscan': overscan,
+                'shape': shape, 'place': place}
+        self._plans[key] = plan
+        return plan
+
+
+# known instruments, see registerInstrument()
+instruments = {}
+
+
+def registerInstrument(instrument):
+    """
+    Add an Instrument to the registry, making it available by name (e.g. to
+    Telload()).
+    """
+
+    instruments[instrument.name] = instrument
+
+
+def getInstrument(name):
+    """
+    Return a registered Instrument.
+    """
+
+    if not(name in instruments):
+        raise ValueError('Unknown instrument: ' + str(name) + '. Known: ' +
+                         ', '.join(sorted(instruments)))
+    return instruments[name]
+
+
+registerInstrument(Instrument('none', description='a generic FITS image'))
+registerInstrument(Instrument('Swope', description='the Swope imager',
+                              imgkey='EXPTYPE'))
+# VATT 4k CCD: two amplifiers, the 2nd one needs to be flipped since it's
+# reading out the other way. Returned in the original orientation.
+registerInstrument(Instrument('VATT', description='the VATT',
+                              exts=[1, 2], layout='side', transpose=False,
+                              trim=True, flip=[1], overscan='BIASSEC'))
+# Bok 90Prime images have 17 HDU objects. 1 for the overall file and 1 for
+# each amplifier
+registerInstrument(Instrument('90Prime',
+                              description='the Bok 90Prime imager',
+                              exts='all', layout='stack',
+                              overscan='BIASSEC'))
+registerInstrument(Instrument('LUCIFER', description='LBT LUCIFER',
+                              imgkey=None, filterkeys=['FILTER1', 'FILTER2'],
+                              keywords=['OBJECT', 'ITIME', 'NDIT',
+                                        'READMODE', 'FILTER1', 'FILTER2',
+                                        'CAMERA', 'GRATNAME', 'DATE-OBS',
+                                        'MJD-OBS', 'AIRMASS', 'RA', 'DEC',
+                                        'OBSTYPE']))
+# MUSE raw frames have one extension per IFU (24)
+registerInstrument(Instrument('MUSE', description='VLT MUSE', exts='all',
+                              layout='stack', imgkey='ESO DPR TYPE',
+                              filterkeys=[],
+                              keywords=['HIERARCH ESO PRO CATG',
+                                        'ESO DPR CATG', 'ESO DPR TYPE'],
+                              lazy=True))
+
+
+class TelAmps(object):
+    """
+    Lazy, per-amplifier access to a frame, with the amplifiers arranged as
+    in Telload(). The file is opened once (memory-mapped) and stays open
+    until close() is called; amps[i] returns amplifier i, a view of the file
+    unless it needs BZERO/BSCALE scaling or conversion to dtype.
+
+    Supports the instruments in the registry (Tel=, see Instrument).
+    """
+
+    def __init__(self, fname, Tel='none', mode='readonly', dtype=None):
+        self.instrument = getInstrument(Tel)
+        self.dtype = dtype
+        # scaling is applied per amplifier, so the raw data can be mapped
+        self.frame = _pyfits.open(fname, mode=mode,
+                                  do_not_scale_image_data=True)
+        self.plan = self.instrument.plan(self.frame)
+        self.exts = self.plan['exts']
+
+    def __len__(self):
+        return len(self.exts)
+
+    def raw(self, amp, native=False):
+        """
+        Return a view of the raw (unscaled) data of an amplifier, trimmed,
+        flipped and (unless native=True) transposed as in Telload().
+        Memory-mapped data is only read when the view is used.
+        """
+        idata = self.frame[self.exts[amp]].data[self.plan['slices'][amp]]
+        if self.instrument.transpose and not(native):
+            idata = idata.transpose()
+        return idata
+
+    def overscan(self, amp):
+        """
+        Return a view of the raw overscan region of an amplifier, in the
+        FITS (y, x) order, or None if it has none.
+        """
+        if self.plan['overscan'][amp] is None:
+            return None
+        return self.frame[self.exts[amp]].data[self.plan['overscan'][amp]]
+
+    def overscanlevel(self, amp):
+        """
+        Return the median overscan level of each row of an amplifier, shaped
+        to be subtracted from amps[amp], or None if it has no overscan.
+        Rows outside the overscan section get the median of the whole section.
+        """
+        oscan = self.overscan(amp)
+        if oscan is None:
+            return None
+        oscan = _scaleraw(oscan, self.header(amp), dtype=_np.float64)
+        level = _np.full(self.header(amp)['NAXIS2'], _np.median(oscan))
+        level[self.plan['overscan'][amp][0]] = _np.median(oscan, axis=1)
+        level = level[self.plan['slices'][amp][0]]
+        if self.instrument.transpose:
+            return level[_np.newaxis, :]
+        return level[:, _np.newaxis]
+
+    def header(self, amp):
+        """
+        Return the header of an amplifier's extension.
+        """
+        return self.frame[self.exts[amp]].header
+
+    def ampdtype(self, amp):
+        """
+        Return the data type amplifier amp is returned with.
+        """
+        if self.dtype is not None:
+            return _np.dtype(self.dtype)
+        raw = self.raw(amp)
+        return _scaling(self.header(amp), raw)[3] or raw.dtype
+
+    def __getitem__(self, amp):
+        # scale in the file's order, then transpose the result
+        idata = _scaleraw(self.raw(amp, native=True), self.header(amp),
+                          dtype=self.dtype)
+        if self.instrument.transpose:
+            idata = idata.transpose()
+        return idata
+
+    def rows(self, amp, start, stop):
+        """
+        Return rows start:stop (in the file's y order) of an amplifier,
+        scaled and arranged as amps[amp]. Only those rows are read.
+        """
+        idata = _scaleraw(self.raw(amp, native=True)[start:stop],
+                          self.header(amp), dtype=self.dtype)
+        if self.instrument.transpose:
+            idata = idata.transpose()
+        return idata
+
+    def __iter__(self):
+        for amp in range(len(self.exts)):
+            yield self[amp]
+
+    def mosaic(self):
+        """
+        Return all amplifiers arranged in a single (new) array, or for a
+        single amplifier, the amplifier itself.
+        """
+
+        if len(self.exts) == 1 and self.plan['place'][0] is Ellipsis:
+            return self[0]
+        dtype = _np.result_type(*[self.ampdtype(amp)
+                                  for amp in range(len(self.exts))])
+        ff = _np.empty(self.plan['shape'], dtype=dtype.newbyteorder('='))
+        for amp in range(len(self.exts)):
+            _scaleraw(self.raw(amp), self.header(amp),
+                      out=ff[self.plan['place'][amp]])
+        return ff
+
+    def close(self):
+        """
+        Close the underlying file.
+        """
+        self.frame.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def Telload(fname, Tel='none', mode='readonly', quiet=True, lazy=None,
+            dtype=None):
+    """
+
+    Load and appropriately arrange a fits file based on the specific
+    telescope/instrument, as described in the instrument registry
+    (see Instrument and registerInstrument()).
 
     Currently supported (Tel=)
+        none (single image, transposed as in fitsopen())
         VATT (VATT 4k CCD)
         90Prime (Bok 90Prime Imager)
         Swope (CCD Imager)
+        LUCIFER (LBT LUCIFER)
+        MUSE (VLT MUSE, one amplifier per IFU)
+
+    The file is opened once (memory-mapped) and multi-extension frames are
+    scaled straight into a preallocated array. With lazy=True, a TelAmps
+    object with per-amplifier views is returned instead (the default for
+    instruments declared lazy).
+
+    dtype sets the data type of the returned array (see fitsopen()).
     """
 
-    if Tel == 'none':
-        if not(quiet):
-            _sys.stderr.write('No telescope specified, running fitsopen()\n')
-        ff = fitsopen(fname, mode=mode, quiet=quiet)
-    elif Tel == 'VATT':
-        if not(quiet):
-            print("Loading FITS file for the VATT")
-        # load both fits extensions (and re-transpose to put them in the orig format)
-        # 2nd one needs to be flipped since it's reading out the other way
-        ext1 = fitsopen(fname, mode=mode, quiet=quiet, ext=1, trim=1).transpose()
-        ext2 = _np.fliplr(fitsopen(fname, mode=mode, quiet=quiet,
-                                   ext=2, trim=1).transpose())
-
-        # concatenate the two halves of the image
-        ff = _np.concatenate((ext1, ext2), axis=1)
-
-    elif Tel == 'Swope':
-        if not(quiet):
-            print("Loading FITS file for the Swope imager.")
-        ff = fitsopen(fname, mode=mode, quiet=quiet)
-    elif Tel == "90Prime":
-        if not(quiet):
-            print("Loading FITS file for the Bok 90Prime imager.")
-        # Bok 90Prime images have 17 HDU objects. 1 for the overall file and 1 for
-        # each amplifier
-        # stack these into a 3D array and return it? handle the calibration files
-        # in the same way?
-
-        # first, figure out how many HDUs there are...
-        frame = _pyfits.open(fname)
-        nHDU = len(frame) - 1 # ditch the overall HDU
-        frame.close()
-        # load the first frame to get us started
-        ext1 = fitsopen(fname, mode=mode, quiet=quiet, ext=1, trim=0)
-        shape = ext1.shape
-        ext1 = ext1.reshape((1, shape[0], shape[1]))
-        ext2 = fitsopen(fname, mode=mode, quiet=quiet, ext=2, trim=0)
-        shape = ext2.shape
-        ext2 = ext2.reshape((1, shape[0], shape[1]))
-        ff = _np.concatenate((ext1, ext2), axis=0)
-        for hdu in range(3, nHDU+1, 1):
-            extt = fitsopen(fname, mode=mode, quiet=quiet, ext=hdu, trim=0)
-            shape = extt.shape
-            extt = extt.reshape((1, shape[0], shape[1]))
-            ff = _np.concatenate((ff, extt), axis=0)
+    instrument = getInstrument(Tel)
+    if lazy is None:
+        lazy = instrument.lazy
+    if lazy:
+        return TelAmps(fname, Tel=Tel, mode=mode, dtype=dtype)
+
+    if not(quiet):
+        print("Loading FITS file for " + instrument.description + ".")
+    if not(_os.path.isfile(fname)):
+        _sys.stderr.write('Error: ' + fname + ' not found.')
+        return -1
+    with TelAmps(fname, Tel=Tel, mode=mode, dtype=dtype) as amps:
+        ff = amps.mosaic()
+        if not quiet:
+            for amp in range(len(amps)):
+                print(fname + " HDU(" + str(amps.exts[amp]) +
+                      ") opened successfully with dimensions " +
+                      str(amps.raw(amp).shape))
 
     return ff
 